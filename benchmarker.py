@@ -1,4 +1,10 @@
 import os
+import sys
+import shlex
+import time
+import resource
+import threading
+import traceback
 import argparse
 from tqdm import tqdm
 
@@ -127,15 +133,53 @@ def generate_test(device, file="benchmark_configs.txt", subfolders=False, small_
         f.write(f'whisper-timestamped-openai_float32_greedy_model-bofenghuang/whisper-large-v3-french-distil-dec2{suffixe}\n')
 
 
-def run_commands(hardware, device, data, model_size, subfolder, args):
+def config_arguments(params, device, data, data_silence, model_size, subfolder, sub_path):
+    """the command line arguments of whisper_online_full_options.py for one config line, split by "_" into params"""
+    backend = params[0]
+    if backend.startswith('whisper'):
+        backend = '_'.join(backend.split("-", 1))
+    model = model_size
+    if "medium" in params:
+        model="medium"
+    elif "large-v1" in params:
+        model="large-v1"
+    elif "tiny" in params:
+        model="tiny"
+    elif len([x for x in params if x.startswith('model-')])>0:
+        model = [x for x in params if x.startswith('model-')][0].split("-",1)[1]
+    tmp = [i for i in params if i.startswith('mcs')]
+    min_chunk_size = tmp[0].split("-")[1] if tmp else MIN_CHUNK_SIZE
+    tmp = [i for i in params if i.startswith('bts')]
+    buffer_trimming_sec = tmp[0].split("-")[1] if tmp else BUFFER_TRIMMING_SEC
+    argv = [data_silence if "silence" in params else data,
+            '--language', LANGUAGE, '--model', model, '--min-chunk-size', str(min_chunk_size), '--buffer_trimming_sec', str(buffer_trimming_sec),
+            '--task', 'transcribe', '--device', device, '--backend', backend, '--compute_type', params[1].replace("-", "_"),
+            '--method', params[2], '--output_path', sub_path]
+    if subfolder:
+        argv.append('--subfolders')
+    tmp = [i for i in params if i.startswith('vad')]
+    if tmp:
+        argv += ('--' + tmp[0].replace("-", " ")).split()  # "vad" or "vad-auditok" -> --vad [auditok]
+    if "previous-text" in params:
+        argv.append('--previous_text')
+    if "offline" in params:
+        argv.append('--offline')
+    tmp = [i for i in params if i[-1]=="t" and len(i)<=3 and i[0].isdigit()]
+    if tmp:
+        argv += ['--cpu_threads', tmp[0][:-1]]
+    return argv
+
+
+def read_configs(hardware, device, data, data_silence, model_size, subfolder, args):
+    """Returns [(line, output sub path, arguments), ...] of the configs in CONFIG_FILE that were not run yet"""
     benchmark_folder = f'{data.split("/")[-1]}_{model_size.split("-")[0]}{"_wer" if subfolder else ""}'
     output_path = os.path.join(benchmark_folder, hardware, device if device != "cuda" else "gpu")
     os.makedirs(output_path, exist_ok=True)
-    pbar = tqdm(total=sum(1 for line in open(CONFIG_FILE, "r") if not line.startswith("#")))
+    configs = []
     with open(CONFIG_FILE, "r") as f:
         for line in f.readlines():
             line = line.strip()
-            if not line.startswith("#"):
+            if line and not line.startswith("#"):
                 params = line.split("_")
                 backend = params[0]
                 if backend.startswith('whisper'):
@@ -143,45 +187,121 @@ def run_commands(hardware, device, data, model_size, subfolder, args):
                 sub_path = os.path.join(output_path, backend, '_'.join(params[1:]).replace('/','-'))
                 if os.path.exists(os.path.join(sub_path, "result.json")) and not args.force_command:
                     print(f'Skipping {sub_path}')
-                    pbar.update(1)
                     continue
-                os.makedirs(sub_path, exist_ok=True)
-                command = ""
-                if device == "cpu":
-                    command = f'/usr/bin/time -o {sub_path}/ram.txt -f "Maximum RSS size: %M KB\nCPU percentage used: %P" '
-                if "silence" in params:
-                    command += f'python whisper_online_full_options.py {data_silence} '
-                else:
-                    command += f'python whisper_online_full_options.py {data} '
-                model = model_size
-                if "medium" in params:
-                    model="medium"
-                elif "large-v1" in params:
-                    model="large-v1"
-                elif "tiny" in params:
-                    model="tiny"
-                elif len([x for x in params if x.startswith('model-')])>0:
-                    model = [x for x in params if x.startswith('model-')][0].split("-",1)[1]
-                tmp = [i for i in params if i.startswith('mcs')]
-                min_chunk_size = tmp[0].split("-")[1] if tmp else MIN_CHUNK_SIZE
-                tmp = [i for i in params if i.startswith('bts')]
-                buffer_trimming_sec = tmp[0].split("-")[1] if tmp else BUFFER_TRIMMING_SEC
-                command += f'--language {LANGUAGE} --model {model} --min-chunk-size {min_chunk_size} --buffer_trimming_sec {buffer_trimming_sec} --task transcribe --device {device} --backend {backend} --compute_type {params[1].replace("-", "_")} --method {params[2]} --output_path {sub_path}'
-                if subfolder:
-                    command += f' --subfolders'
-                tmp = [i for i in params if i.startswith('vad')]
-                if tmp:
-                    command += f' --{tmp[0].replace("-", " ")}'
-                if "previous-text" in params:
-                    command += f' --previous_text'
-                if "offline" in params:
-                    command += f' --offline'
-                tmp = [i for i in params if i[-1]=="t" and len(i)<=3 and i[0].isdigit()]
-                if tmp:
-                    command += f' --cpu_threads {tmp[0][:-1]}'
-                print("Running:\n",command)
-                os.system(command)
+                configs.append((line, sub_path, config_arguments(params, device, data, data_silence, model_size, subfolder, sub_path)))
+    return configs
+
+
+def run_commands(configs, device):
+    """runs every config by a new whisper_online_full_options.py process"""
+    for line, sub_path, argv in tqdm(configs):
+        os.makedirs(sub_path, exist_ok=True)
+        command = ""
+        if device == "cpu":
+            command = f'/usr/bin/time -o {sub_path}/ram.txt -f "Maximum RSS size: %M KB\nCPU percentage used: %P" '
+        command += 'python whisper_online_full_options.py ' + ' '.join(shlex.quote(a) for a in argv)
+        print("Running:\n",command)
+        os.system(command)
+
+
+class PeakMemory:
+    """Measures the peak RSS and the CPU usage of this process while a config runs in it, for ram.txt.
+
+    The peak of getrusage is the peak of the whole process, so the RSS is sampled by a thread from /proc/self/statm.
+    Where it is not available, the peak of the process is used.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0  # KB
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * resource.getpagesize() // 1024
+        except (OSError, IndexError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def sample(self):
+        while True:
+            self.peak = max(self.peak, self.rss())
+            if self.stop_event.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = usage.ru_utime + usage.ru_stime - self.start_usage.ru_utime - self.start_usage.ru_stime
+        self.cpu_percentage = 100 * cpu / max(time.time() - self.start_time, 1e-9)
+
+    def write(self, path):
+        """writes ram.txt in the format of /usr/bin/time in run_commands, read by sumup.py"""
+        with open(os.path.join(path, "ram.txt"), "w") as f:
+            f.write(f"Maximum RSS size: {self.peak} KB\nCPU percentage used: {self.cpu_percentage:.0f}%\n")
+
+
+def run_in_process(configs, device):
+    """Runs the configs in this process. The configs that share the model (backend, model, device, precision and
+    CPU threads) run one after another and the model is loaded only once for them, see whisper_online.ModelRegistry.
+    The results of every config are written when it finishes, so an interrupted run can be resumed. On CPU, the peak
+    memory of every config is written to ram.txt, see PeakMemory."""
+    # the PYTHONPATH set for the hardware, for the imports of whisper_online_full_options
+    for path in os.environ.get('PYTHONPATH', '').split(':'):
+        if path and not path.startswith('$') and path not in sys.path:
+            sys.path.append(path)
+    import whisper_online
+    import whisper_online_full_options as full_options
+
+    def model_key(config):
+        args = full_options.init_args(config[2])
+        return (args.backend, args.model, args.device, args.compute_type, str(args.cpu_threads))
+    groups = {}
+    for config in configs:
+        try:
+            groups.setdefault(model_key(config), []).append(config)
+        except (Exception, SystemExit):
+            print(f"Failed: {config[0]}")
+            traceback.print_exc()
+
+    # the model of a group is unloaded when all its handles are released
+    whisper_online.models.idle_timeout = 0
+    pbar = tqdm(total=len(configs))
+    for key, group in groups.items():
+        print(f"Running {len(group)} configs with {key}")
+        handles = []  # acquired from whisper_online.models by init_processor
+        try:
+            for line, sub_path, argv in group:
+                print("Running:\n", line, ' '.join(argv))
+                try:
+                    args = full_options.init_args(argv)
+                    os.makedirs(sub_path, exist_ok=True)
+                    with PeakMemory() as memory:
+                        online = full_options.init_processor(args, handles=handles)
+                        processing_times = full_options.process_files(full_options.get_file_list(args), args, online)
+                        full_options.export_processing_times(args, processing_times)
+                        full_options.export_params(args)
+                        online.finish()
+                    if device == "cpu":
+                        memory.write(sub_path)
+                except (Exception, SystemExit):
+                    # a failing config must not stop the others
+                    print(f"Failed: {line}")
+                    traceback.print_exc()
                 pbar.update(1)
+        finally:
+            for handle in handles:
+                whisper_online.models.release(handle)
 
 
 if __name__ == '__main__':
@@ -194,6 +314,7 @@ if __name__ == '__main__':
     parser.add_argument('--model_size', type=str, default='large-v3')
     parser.add_argument('--force_command', action="store_true", default=False)
     parser.add_argument('--small_test', action="store_true", default=False)
+    parser.add_argument('--runner', type=str, default="in-process", choices=["in-process", "subprocess"], help="in-process: run all the configs in this process and load every model once, the peak memory of every config on CPU is sampled in the process (ram.txt). subprocess: run every config by a new whisper_online_full_options.py process, measured by /usr/bin/time on CPU.")
     args = parser.parse_args()
     hardware = args.hardware
     device = args.device
@@ -222,4 +343,8 @@ if __name__ == '__main__':
         f.write(f'')
     if not os.path.exists(CONFIG_FILE):
         generate_test(device, CONFIG_FILE, subfolder, small_test=args.small_test)
-    run_commands(hardware, device, data, model_size, subfolder, args)
\ No newline at end of file
+    configs = read_configs(hardware, device, data, data_silence, model_size, subfolder, args)
+    if args.runner == "subprocess":
+        run_commands(configs, device)
+    else:
+        run_in_process(configs, device)
\ No newline at end of file
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Per-stage timings of OnlineASRProcessor.process_iter.
+
+Every iteration produces one IterationStats record: the time of each stage, the buffer length, the number of the
+committed words and the buffer trimming events. The records go to the hooks registered by
+OnlineASRProcessor.add_iteration_hook, and they are aggregated into IterationHistograms, which keeps fixed-bucket
+histograms, so the memory and the cost don't grow with the number of iterations.
+"""
+
+import time
+
+
+# the stages of process_iter, in the order in which they run
+STAGES = ("prompt", "vad", "features", "transcribe", "ts_words", "insert", "flush", "trim")
+
+# upper bounds of the histogram buckets, in seconds
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class IterationStats:
+    """the record of one process_iter call"""
+
+    __slots__ = ("iteration", "buffer_offset", "buffer_seconds", "stages", "committed_words", "trims", "skipped",
+                 "total", "_last")
+
+    def __init__(self, iteration, buffer_offset, buffer_seconds):
+        self.iteration = iteration
+        self.buffer_offset = buffer_offset  # the buffer start in seconds of the stream
+        self.buffer_seconds = buffer_seconds  # the buffer length when the iteration started
+        self.stages = {}  # stage -> seconds
+        self.committed_words = 0
+        self.trims = []  # [(time of the cut in seconds of the stream, seconds cut from the buffer), ...]
+        self.skipped = False  # no ASR call, see OnlineASRProcessor.skip_silent_iteration
+        self.total = 0
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        """adds the time since the previous lap (or since the start) to the stage"""
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self._last
+        self._last = now
+
+    def finish(self):
+        self.total = sum(self.stages.values())
+
+    def as_dict(self):
+        return {
+            "iteration": self.iteration,
+            "buffer_offset": self.buffer_offset,
+            "buffer_seconds": self.buffer_seconds,
+            "stages": dict(self.stages),
+            "committed_words": self.committed_words,
+            "trims": list(self.trims),
+            "skipped": self.skipped,
+            "total": self.total,
+        }
+
+
+class Histogram:
+    """counts of the observed values in fixed buckets, like the Prometheus histogram"""
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets)+1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """the upper bound of the bucket that contains the q-quantile, at most the maximum"""
+        if self.count == 0:
+            return 0
+        rank = q*self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= rank and c:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum/self.count if self.count else 0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class IterationHistograms:
+    """aggregates the IterationStats of a stream"""
+
+    def __init__(self):
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.total = Histogram()
+        self.buffer_seconds = Histogram(buckets=(1, 2, 5, 10, 15, 20, 25, 30, 60))
+        self.iterations = 0
+        self.skipped = 0
+        self.committed_words = 0
+        self.trims = 0
+
+    def add(self, stats):
+        for stage, seconds in stats.stages.items():
+            self.stages[stage].observe(seconds)
+        self.total.observe(stats.total)
+        self.buffer_seconds.observe(stats.buffer_seconds)
+        self.iterations += 1
+        self.skipped += stats.skipped
+        self.committed_words += stats.committed_words
+        self.trims += len(stats.trims)
+
+    def summary(self):
+        return {
+            "iterations": self.iterations,
+            "skipped": self.skipped,
+            "committed_words": self.committed_words,
+            "trims": self.trims,
+            "total": self.total.summary(),
+            "buffer_seconds": self.buffer_seconds.summary(),
+            "stages": {stage: h.summary() for stage, h in self.stages.items() if h.count},
+        }
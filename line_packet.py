@@ -11,10 +11,38 @@ containing:
 
   - Zero or more \0 bytes as required to pad the packet to PACKET_SIZE
 
+The framed format is the compact alternative, negotiated per connection. The
+client starts the connection by the 8-byte handshake: HANDSHAKE_MAGIC, the
+protocol version and a byte of flags, and the server answers by the same
+handshake with the flags it accepted. Then every line is transmitted as one
+frame:
+
+  - 4 bytes of the length of the text, big-endian unsigned, followed by
+
+  - the text in UTF-8, without a line break
+
+A client that doesn't send the handshake gets the padded packets. A client
+written in Python calls start_framed, which does the handshake and returns the
+FrameDecoder for receive_frames.
+
+Flags of the handshake:
+
+  - FLAG_INTERIM: the lines are typed by their first character, "C" is a
+    committed segment, "I" is the interim hypothesis, which replaces the
+    previous one
+
 """
 
+import struct
+
 PACKET_SIZE = 65536
 
+HANDSHAKE_MAGIC = b"WSLF\0\0"  # followed by the version and the flags
+HANDSHAKE_SIZE = len(HANDSHAKE_MAGIC) + 2
+FRAMED_VERSION = 1
+FLAG_INTERIM = 1
+_FRAME_HEADER = struct.Struct(">I")
+
 
 def send_one_line(socket, text):
     """Sends a line of text over the given socket.
@@ -32,11 +60,27 @@ def send_one_line(socket, text):
         socket: a socket object.
         text: string containing a line of text for transmission.
     """
-    text.replace('\0', '\n')
+    for packet in encode_one_line(text):
+        socket.sendall(packet)
+
+
+def encode_one_line(text):
+    """Encodes a line of text into the fixed-size packets sent by send_one_line.
+
+    It is used for the transports that don't have sendall, e.g. asyncio streams.
+
+    Args:
+        text: string containing a line of text for transmission.
+
+    Returns:
+        A list of bytes objects, each of them PACKET_SIZE long.
+    """
+    text = text.replace('\0', '\n')
     lines = text.splitlines()
     first_line = '' if len(lines) == 0 else lines[0]
     # TODO Is there a better way of handling bad input than 'replace'?
     data = first_line.encode('utf-8', errors='replace') + b'\n\0'
+    packets = []
     for offset in range(0, len(data), PACKET_SIZE):
         bytes_remaining = len(data) - offset
         if bytes_remaining < PACKET_SIZE:
@@ -44,7 +88,8 @@ def send_one_line(socket, text):
             packet = data[offset:] + b'\0' * padding_length
         else:
             packet = data[offset:offset+PACKET_SIZE]
-        socket.sendall(packet)
+        packets.append(packet)
+    return packets
 
 
 def receive_one_line(socket):
@@ -65,14 +110,15 @@ def receive_one_line(socket):
         A string representing a single line with a terminating newline or
         None if the connection has been closed.
     """
-    data = b''
+    packets = []
     while True:
         packet = socket.recv(PACKET_SIZE)
         if not packet:  # Connection has been closed.
             return None
-        data += packet
+        packets.append(packet)
         if b'\0' in packet:
             break
+    data = b''.join(packets)
     # TODO Is there a better way of handling bad input than 'replace'?
     text = data.decode('utf-8', errors='replace').strip('\0')
     lines = text.split('\n')
@@ -92,3 +138,104 @@ def receive_lines(socket):
     if len(lines)==1 and not lines[0]:
         return None
     return lines
+
+
+def encode_handshake(flags=0, version=FRAMED_VERSION):
+    """Returns the handshake that selects the framed format, see the module docstring."""
+    return HANDSHAKE_MAGIC + bytes([version, flags])
+
+
+def parse_handshake(data):
+    """Returns (version, flags) if data starts with the handshake, otherwise None."""
+    if len(data) < HANDSHAKE_SIZE or not data.startswith(HANDSHAKE_MAGIC):
+        return None
+    return data[len(HANDSHAKE_MAGIC)], data[len(HANDSHAKE_MAGIC)+1]
+
+
+def start_framed(socket, flags=0):
+    """Starts the framed format on the client side of a connection.
+
+    It sends the handshake, waits for the handshake of the server and checks
+    it. It must be called before any audio is sent.
+
+    Args:
+        socket: a socket object.
+        flags: the flags the client asks for, e.g. FLAG_INTERIM.
+
+    Returns:
+        A FrameDecoder for receive_frames. Its 'flags' attribute holds the
+        flags the server accepted, which may be fewer than requested.
+
+    Raises:
+        ConnectionError if the connection is closed before the handshake of
+        the server arrives, ValueError if the server answers something else
+        than the handshake of the same version.
+    """
+    socket.sendall(encode_handshake(flags))
+    data = b''
+    while len(data) < HANDSHAKE_SIZE:
+        packet = socket.recv(HANDSHAKE_SIZE - len(data))
+        if not packet:  # Connection has been closed.
+            raise ConnectionError("connection closed during the handshake")
+        data += packet
+    handshake = parse_handshake(data)
+    if handshake is None or handshake[0] != FRAMED_VERSION:
+        raise ValueError(f"unexpected handshake of the server: {data!r}")
+    return FrameDecoder(handshake[1])
+
+
+def encode_frame(text):
+    """Encodes one line of text into a length-prefixed frame. Only the first line of text is sent, as by send_one_line."""
+    lines = text.replace('\0', '\n').splitlines()
+    data = ('' if len(lines) == 0 else lines[0]).encode('utf-8', errors='replace')
+    return _FRAME_HEADER.pack(len(data)) + data
+
+
+def encode_frames(texts):
+    """Encodes several lines into one bytes object, so that they can be sent by one call."""
+    return b''.join(encode_frame(t) for t in texts)
+
+
+def send_frames(socket, texts):
+    """Sends the lines of texts as frames by one sendall."""
+    socket.sendall(encode_frames(texts))
+
+
+class FrameDecoder:
+    """Decodes the framed format from a byte stream that arrives in arbitrary pieces.
+
+    feed() takes the received bytes and returns the lines of all the frames that are complete. The bytes of an
+    incomplete frame are kept for the next call. flags are the flags of the handshake accepted by the server.
+    """
+
+    def __init__(self, flags=0):
+        self.buffer = bytearray()
+        self.flags = flags
+
+    def feed(self, data):
+        self.buffer += data
+        lines = []
+        offset = 0
+        while len(self.buffer) - offset >= _FRAME_HEADER.size:
+            (length,) = _FRAME_HEADER.unpack_from(self.buffer, offset)
+            end = offset + _FRAME_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            lines.append(self.buffer[offset+_FRAME_HEADER.size:end].decode('utf-8', errors='replace'))
+            offset = end
+        del self.buffer[:offset]
+        return lines
+
+
+def receive_frames(socket, decoder):
+    """Receives the available data and returns the complete lines, [] if no line is complete yet, or None if the
+    connection has been closed.
+
+    Args:
+        socket: a socket object.
+        decoder: the FrameDecoder of the connection.
+    """
+    data = socket.recv(PACKET_SIZE)
+    if not data:  # Connection has been closed.
+        return None
+    return decoder.feed(data)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Incremental log-mel features of the streaming audio buffer.
+
+Whisper backends compute the log-mel spectrogram of the whole audio buffer in every process_iter call, although
+most of the buffer was already seen in the previous calls. MelFeatureCache keeps the STFT/mel frames of the buffer
+between the calls, computes only the frames of the newly inserted samples, and drops the frames when the buffer is
+trimmed. features() returns the same matrix as the backend's feature extractor would.
+
+A frame depends on n_fft samples around its center. Only the frames whose whole window lies inside the buffer are
+cached ("interior" frames, on a grid of hop_length samples from the stream start). The few frames at the buffer
+edges, that depend on the reflection padding and on the zero padding of the backend, are recomputed in every call.
+The final clamping and scaling of Whisper depends on the maximum over the whole buffer, so it is applied in
+features() too. Both are cheap compared to the STFT of the whole buffer.
+"""
+
+import inspect
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class MelFeatureCache:
+
+    def __init__(self, feature_extractor):
+        """feature_extractor: the feature extractor of the backend, e.g. faster_whisper.feature_extractor.FeatureExtractor.
+        The STFT parameters, mel filters and padding are taken from it, so that the features are the same.
+        """
+        self.feature_extractor = feature_extractor
+        self.n_fft = feature_extractor.n_fft
+        self.hop_length = feature_extractor.hop_length
+        self.mel_filters = np.asarray(feature_extractor.mel_filters, dtype=np.float32)
+        self.window = np.hanning(self.n_fft + 1)[:-1].astype(np.float32)
+        self.half = self.n_fft // 2
+
+        # the zero padding appended by the feature extractor: all of n_samples in older faster-whisper, a number of samples in the newer ones
+        padding = inspect.signature(feature_extractor.__call__).parameters.get("padding")
+        padding = True if padding is None else padding.default
+        if padding is True:
+            self.padding = int(feature_extractor.n_samples)
+        else:
+            self.padding = int(padding)
+
+        self.frames = np.empty((0, self.mel_filters.shape[0]), dtype=np.float32)
+        self.beg = 0  # the cached frames are self.frames[self.beg:self.end]
+        self.end = 0
+        self.first_frame = 0  # absolute index of the frame self.frames[self.beg]
+
+        self.verified = False
+        self.enabled = True
+
+    def reset(self):
+        self.beg = self.end = 0
+        self.first_frame = 0
+
+    def aligned(self, sample_offset):
+        """the buffer can use the cache only if it starts on the frame grid"""
+        return sample_offset % self.hop_length == 0
+
+    def trim(self, sample_offset):
+        """drops the frames that are not interior frames of a buffer starting at the absolute sample_offset"""
+        first = -(-(sample_offset + self.half) // self.hop_length)  # ceil
+        drop = min(max(first - self.first_frame, 0), self.end - self.beg)
+        self.beg += drop
+        self.first_frame += drop
+        if self.beg == self.end:
+            self.beg = self.end = 0
+            self.first_frame = max(self.first_frame, first)
+
+    def features(self, audio, sample_offset):
+        """audio: the buffer, starting at the absolute sample sample_offset of the stream.
+        Returns the normalized log-mel features of the buffer, or None if the cache can't be used.
+        """
+        if not self.enabled or len(audio) == 0 or not self.aligned(sample_offset):
+            return None
+        self.trim(sample_offset)
+        self._update(audio, sample_offset)
+
+        n = len(audio)
+        length = n + self.padding
+        n_frames = length // self.hop_length
+        frame0 = sample_offset // self.hop_length
+        cached_beg = min(self.first_frame - frame0, n_frames)
+        cached_end = min(cached_beg + self.end - self.beg, n_frames)
+
+        log_spec = np.full((n_frames, self.mel_filters.shape[0]), -10.0, dtype=np.float32)  # log10(1e-10) of the zero padding
+        log_spec[cached_beg:cached_end] = self.frames[self.beg:self.beg+cached_end-cached_beg]
+        log_spec[:cached_beg] = self._frames(audio, length, 0, cached_beg)
+        # beyond this frame, the window lies only in the zero padding
+        tail_end = min(n_frames, (n + self.n_fft) // self.hop_length + 1)
+        if tail_end > cached_end:
+            log_spec[cached_end:tail_end] = self._frames(audio, length, cached_end, tail_end)
+
+        log_spec = np.maximum(log_spec, log_spec.max() - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        features = log_spec.T
+
+        if not self.verified:
+            self._verify(audio, features)
+        return features if self.enabled else None
+
+    def _verify(self, audio, features):
+        # the feature extractors differ between the backend versions, it is checked once with the real one
+        expected = np.asarray(self.feature_extractor(audio))
+        if expected.shape != features.shape or not np.allclose(expected, features, atol=1e-3):
+            logger.warning("cached log-mel features differ from the backend's feature extractor, the feature cache is disabled")
+            self.enabled = False
+        self.verified = True
+
+    def _update(self, audio, sample_offset):
+        # the interior frames of the buffer: the whole window lies inside of the buffer
+        first = -(-(sample_offset + self.half) // self.hop_length)
+        last = (sample_offset + len(audio) - self.half) // self.hop_length  # inclusive
+        if self.end == self.beg:
+            self.first_frame = first
+        next_frame = max(self.first_frame + self.end - self.beg, first)
+        if next_frame > last:
+            return
+        start = next_frame*self.hop_length - self.half - sample_offset
+        stop = last*self.hop_length + self.half - sample_offset
+        new = self._log_mel(audio[start:stop])
+        self._append(new)
+
+    def _append(self, new):
+        n = len(new)
+        if self.end + n > len(self.frames):
+            size = self.end - self.beg
+            capacity = max(len(self.frames), 1)
+            while size + n > capacity // 2:
+                capacity *= 2
+            frames = np.empty((capacity, self.frames.shape[1]), dtype=np.float32) if capacity != len(self.frames) else self.frames
+            frames[:size] = self.frames[self.beg:self.end]
+            self.frames = frames
+            self.beg = 0
+            self.end = size
+        self.frames[self.end:self.end+n] = new
+        self.end += n
+
+    def _frames(self, audio, length, beg, end):
+        """log-mel of the frames beg..end of the buffer padded like by the feature extractor:
+        zeros up to length samples, then reflection by n_fft/2 on both sides"""
+        if end <= beg:
+            return np.empty((0, self.mel_filters.shape[0]), dtype=np.float32)
+        idx = np.arange(beg*self.hop_length - self.half, (end-1)*self.hop_length + self.half)
+        idx = np.abs(idx)
+        idx = np.where(idx >= length, 2*length - 2 - idx, idx)
+        n = len(audio)
+        samples = np.where(idx < n, audio[np.minimum(idx, n-1)], 0).astype(np.float32)
+        return self._log_mel(samples)
+
+    def _log_mel(self, samples):
+        windows = np.lib.stride_tricks.sliding_window_view(samples, self.n_fft)[::self.hop_length]
+        power = np.abs(np.fft.rfft(windows * self.window, axis=-1)) ** 2
+        mel = power.astype(np.float32) @ self.mel_filters.T
+        return np.log10(np.maximum(mel, 1e-10))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Metrics of the streaming server in the Prometheus text format, served by a small asyncio HTTP endpoint.
+
+SessionMetrics counts one client session, ServerMetrics the whole server: the active sessions and the totals of the
+ended ones. Both are updated in the event loop of the server, after every received packet and every process_iter
+call, and rendered on a GET /metrics request.
+"""
+
+import asyncio
+import logging
+import time
+
+from iteration_stats import Histogram, TIME_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+RTF_BUCKETS = (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5)
+BUFFER_BUCKETS = (1, 2, 5, 10, 15, 20, 25, 30, 60)
+LAG_BUCKETS = (0.5, 1, 2, 3, 5, 10, 20, 30, 60)
+
+
+class SessionMetrics:
+    '''counters of one client session, logged when the session ends'''
+
+    def __init__(self, session_id, peer, server_metrics=None):
+        self.session_id = session_id
+        self.peer = peer
+        self.server_metrics = server_metrics
+        self.started = time.time()
+
+        self.packets = 0
+        self.bytes = 0
+        self.audio_seconds = 0
+        self.iterations = 0
+        self.processing_time = 0
+        self.max_processing_time = 0
+        self.committed_words = 0
+        self.committed_end = None
+        self.skipped_iterations = 0
+        self.buffer_seconds = 0
+        self.min_chunk_size = None  # the current one, it changes with --target-latency
+        self.degraded = False  # transcribed by the fallback model, see whisper_online.CascadeASR
+        self.fallback_switches = 0
+        self.iteration_seconds = Histogram(TIME_BUCKETS)
+
+    def add_packet(self, raw_bytes):
+        self.packets += 1
+        self.bytes += len(raw_bytes)
+        if self.server_metrics is not None:
+            self.server_metrics.packets += 1
+            self.server_metrics.bytes += len(raw_bytes)
+
+    def add_iteration(self, chunk_seconds, processing_time, committed_words, committed_end, buffer_seconds=0):
+        self.audio_seconds += chunk_seconds
+        self.iterations += 1
+        self.processing_time += processing_time
+        self.max_processing_time = max(self.max_processing_time, processing_time)
+        self.committed_words += committed_words
+        if committed_end is not None:
+            self.committed_end = committed_end
+        self.buffer_seconds = buffer_seconds
+        self.iteration_seconds.observe(processing_time)
+        if self.server_metrics is not None:
+            self.server_metrics.add_iteration(self, chunk_seconds, processing_time, committed_words)
+
+    def add_switch(self, degraded):
+        self.degraded = degraded
+        self.fallback_switches += 1
+        if self.server_metrics is not None:
+            self.server_metrics.fallback_switches += 1
+            if degraded:
+                self.server_metrics.degradations += 1
+
+    def real_time_factor(self):
+        if self.audio_seconds == 0:
+            return 0
+        return self.processing_time/self.audio_seconds
+
+    def committed_lag(self):
+        '''how far the committed transcript is behind the received audio, in seconds'''
+        return self.audio_seconds - (self.committed_end or 0)
+
+    def summary(self):
+        return (f"session {self.session_id} {self.peer}: {time.time()-self.started:.2f}s connected, "
+                f"{self.packets} packets ({self.bytes} bytes), {self.audio_seconds:.2f}s of audio, "
+                f"{self.iterations} iterations ({self.skipped_iterations} without ASR), {self.committed_words} committed words, "
+                f"{self.fallback_switches} fallback switches, "
+                f"processing {self.processing_time:.2f}s (max {self.max_processing_time:.2f}s, RTF {self.real_time_factor():.2f})")
+
+
+class ServerMetrics:
+    '''the metrics of all the sessions of the server'''
+
+    def __init__(self):
+        self.sessions = {}  # session id -> SessionMetrics of the active sessions
+        self.started = time.time()
+
+        self.connections = 0
+        self.refused = 0
+        self.packets = 0
+        self.bytes = 0
+        self.audio_seconds = 0
+        self.iterations = 0
+        self.committed_words = 0
+        self.fallback_switches = 0
+        self.degradations = 0  # the switches to the fallback model
+
+        self.iteration_seconds = Histogram(TIME_BUCKETS)
+        self.real_time_factor = Histogram(RTF_BUCKETS)  # of the iterations: processing time / new audio
+        self.buffer_seconds = Histogram(BUFFER_BUCKETS)
+        self.committed_lag = Histogram(LAG_BUCKETS)
+
+    def new_session(self, session_id, peer):
+        metrics = SessionMetrics(session_id, peer, server_metrics=self)
+        self.sessions[session_id] = metrics
+        self.connections += 1
+        return metrics
+
+    def end_session(self, metrics):
+        del self.sessions[metrics.session_id]
+
+    def add_iteration(self, session, chunk_seconds, processing_time, committed_words):
+        self.audio_seconds += chunk_seconds
+        self.iterations += 1
+        self.committed_words += committed_words
+        self.iteration_seconds.observe(processing_time)
+        if chunk_seconds > 0:
+            self.real_time_factor.observe(processing_time/chunk_seconds)
+        self.buffer_seconds.observe(session.buffer_seconds)
+        self.committed_lag.observe(session.committed_lag())
+
+    def render(self):
+        '''returns the metrics in the Prometheus text exposition format'''
+        out = []
+        def metric(name, kind, help, samples):
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                out.append(f"{name}{_labels(labels)} {value}")
+        def histogram(name, help, histograms):
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} histogram")
+            for labels, h in histograms:
+                n = 0
+                for le, c in zip(h.buckets + ("+Inf",), h.counts):
+                    n += c
+                    out.append(f"{name}_bucket{_labels(dict(labels, le=le))} {n}")
+                out.append(f"{name}_sum{_labels(labels)} {h.sum}")
+                out.append(f"{name}_count{_labels(labels)} {h.count}")
+
+        sessions = list(self.sessions.values())
+        def per_session(value):
+            return [({"session": s.session_id}, value(s)) for s in sessions]
+
+        metric("whisper_uptime_seconds", "gauge", "Time since the server started.", [({}, time.time()-self.started)])
+        metric("whisper_active_sessions", "gauge", "Number of the connected clients.", [({}, len(sessions))])
+        metric("whisper_connections_total", "counter", "Accepted client connections.", [({}, self.connections)])
+        metric("whisper_refused_connections_total", "counter", "Connections refused because of --max-sessions.", [({}, self.refused)])
+        metric("whisper_packets_total", "counter", "Received audio packets.", [({}, self.packets)])
+        metric("whisper_received_bytes_total", "counter", "Received audio bytes.", [({}, self.bytes)])
+        metric("whisper_audio_seconds_total", "counter", "Processed audio.", [({}, self.audio_seconds)])
+        metric("whisper_iterations_total", "counter", "process_iter calls.", [({}, self.iterations)])
+        metric("whisper_committed_words_total", "counter", "Committed words.", [({}, self.committed_words)])
+        metric("whisper_fallback_switches_total", "counter", "Switches of the sessions between the primary and the fallback model.", [({}, self.fallback_switches)])
+        metric("whisper_degradations_total", "counter", "Switches of the sessions to the fallback model.", [({}, self.degradations)])
+        metric("whisper_degraded_sessions", "gauge", "Sessions transcribed by the fallback model.", [({}, sum(s.degraded for s in sessions))])
+        histogram("whisper_iteration_seconds", "Processing time of one iteration.", [({}, self.iteration_seconds)])
+        histogram("whisper_iteration_real_time_factor", "Processing time of an iteration divided by the length of its new audio.", [({}, self.real_time_factor)])
+        histogram("whisper_buffer_seconds", "Audio buffer length after an iteration.", [({}, self.buffer_seconds)])
+        histogram("whisper_committed_lag_seconds", "Received audio minus the end of the committed transcript, after an iteration.", [({}, self.committed_lag)])
+
+        metric("whisper_session_packets_total", "counter", "Received audio packets of the session.", per_session(lambda s: s.packets))
+        metric("whisper_session_received_bytes_total", "counter", "Received audio bytes of the session.", per_session(lambda s: s.bytes))
+        metric("whisper_session_audio_seconds_total", "counter", "Processed audio of the session.", per_session(lambda s: s.audio_seconds))
+        metric("whisper_session_real_time_factor", "gauge", "Processing time divided by the audio length of the session.", per_session(lambda s: s.real_time_factor()))
+        metric("whisper_session_buffer_seconds", "gauge", "Audio buffer length of the session.", per_session(lambda s: s.buffer_seconds))
+        metric("whisper_session_min_chunk_seconds", "gauge", "Current minimum chunk size of the session.", [({"session": s.session_id}, s.min_chunk_size) for s in sessions if s.min_chunk_size is not None])
+        metric("whisper_session_committed_lag_seconds", "gauge", "Received audio minus the end of the committed transcript of the session.", per_session(lambda s: s.committed_lag()))
+        metric("whisper_session_degraded", "gauge", "1 if the session is transcribed by the fallback model.", per_session(lambda s: int(s.degraded)))
+        histogram("whisper_session_iteration_seconds", "Processing time of one iteration of the session.", [({"session": s.session_id}, s.iteration_seconds) for s in sessions])
+        return "\n".join(out) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+class MetricsHTTPServer:
+    '''serves GET /metrics over HTTP/1.0, one response per connection'''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # the headers are not needed
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+                body = self.metrics.render().encode("utf-8")
+                status = "200 OK"
+            else:
+                body = b"not found\n"
+                status = "404 Not Found"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f"Metrics on http://{host}:{port}/metrics")
+        return server
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Import-time profile of the startup, like `python -X importtime`, but switched on by an option of the entry point.
+
+The heavy libraries (torch, the Whisper backends, librosa, wtpsplit) are imported lazily, only in the code paths
+that need them, so a profile of the whole startup shows which of them were actually imported and what they cost.
+"""
+
+import builtins
+import sys
+import time
+
+
+class ImportProfiler:
+    """Measures the first import of every module that goes through the import statement.
+    The modules imported by importlib.import_module and by relative imports are counted in their importer's time.
+    """
+
+    def __init__(self):
+        self.times = {}  # module -> (self seconds, cumulative seconds)
+        self.stack = []  # cumulative seconds of the child imports of the imports in progress
+        self.original_import = None
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.original_import = builtins.__import__
+        builtins.__import__ = self._import
+
+    def stop(self):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+        self.stack.append(0.0)
+        t = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.perf_counter() - t
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += cumulative
+            self.times[name] = (cumulative - children, cumulative)
+
+    def report(self, top=20):
+        """Returns the lines of the report: the total import time, the peak memory and the slowest imports."""
+        total = sum(s for s, _ in self.times.values())
+        lines = [f"startup profile: {total:.2f}s in {len(self.times)} imports, {time.perf_counter()-self.started:.2f}s since the start of profiling"]
+        try:
+            import resource
+            # kilobytes on Linux
+            lines.append(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024:.0f} MB")
+        except ImportError:
+            pass
+        lines.append(f"{'self [s]':>9} {'cumulative [s]':>15}  module")
+        for name, (own, cumulative) in sorted(self.times.items(), key=lambda x: -x[1][1])[:top]:
+            lines.append(f"{own:9.3f} {cumulative:15.3f}  {name}")
+        return lines
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Voice activity detection that follows the streaming audio buffer.
+
+The Silero model is run only on the samples appended since the previous call. Its recurrent state and the speech
+segments found so far are kept, and the segments are dropped when the buffer is trimmed. The outputs are the same
+as of whisper_timestamped's remove_non_speech(method="silero"): the speech-only audio, the speech segments in
+seconds of the buffer, and the function that converts the timestamps in the speech-only audio back to the buffer.
+"""
+
+import copy
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# the Silero model loaded once per process, every stream gets its own copy with its own state
+_silero = None
+_silero_lock = threading.Lock()
+
+
+def _load_silero():
+    global _silero
+    with _silero_lock:
+        if _silero is None:
+            import torch
+            # the same model as whisper_timestamped uses. A repo that is already in the torch hub cache is loaded
+            # from there, without asking GitHub for its default branch.
+            local = os.path.join(torch.hub.get_dir(), "snakers4_silero-vad_master")
+            if os.path.isdir(local):
+                _silero, _ = torch.hub.load(repo_or_dir=local, model="silero_vad", source="local", onnx=False)
+            else:
+                _silero, _ = torch.hub.load(repo_or_dir="snakers4/silero-vad", model="silero_vad", onnx=False, trust_repo=True)
+        return _silero
+
+
+class StreamingVAD:
+
+    SAMPLING_RATE = 16000
+    WINDOW = 512  # samples per Silero call at 16 kHz
+
+    def __init__(self, threshold=0.5, min_speech_duration=0.1, min_silence_duration=1, dilatation=0.5):
+        """The parameters have the meaning and the defaults of whisper_timestamped.transcribe.remove_non_speech"""
+        self.threshold = threshold
+        self.neg_threshold = max(threshold - 0.15, 0.01)
+        self.min_speech_samples = int(min_speech_duration*self.SAMPLING_RATE)
+        self.min_silence_samples = int(min_silence_duration*self.SAMPLING_RATE)
+        self.dilatation_samples = int(dilatation*self.SAMPLING_RATE)
+
+        self.model = self.load_model()
+        self.reset()
+
+    def load_model(self):
+        import torch
+        self.torch = torch
+        # one instance per stream, because it keeps the state of the stream
+        return copy.deepcopy(_load_silero())
+
+    def reset(self):
+        """run this when starting or restarting processing"""
+        self.model.reset_states()
+        self.processed = 0  # absolute number of samples that were passed to the model
+        self.segments = []  # closed speech segments, [beg, end] in absolute samples
+        self.triggered = False
+        self.current_start = 0
+        self.temp_end = 0
+
+    def trim(self, sample_offset):
+        """forgets the speech segments that end before the absolute sample_offset"""
+        while self.segments and self.segments[0][1] <= sample_offset:
+            self.segments.pop(0)
+
+    def update(self, audio, sample_offset):
+        """runs the model on the samples of audio that were not processed yet.
+        audio: the buffer that starts at the absolute sample_offset of the stream
+        """
+        if self.processed < sample_offset:
+            # the unprocessed audio was trimmed away
+            self.model.reset_states()
+            self.triggered = False
+            self.temp_end = 0
+            self.processed = sample_offset
+        beg = self.processed - sample_offset
+        n = (len(audio) - beg) // self.WINDOW
+        if n <= 0:
+            return
+        windows = audio[beg:beg + n*self.WINDOW].reshape(n, self.WINDOW)
+        with self.torch.no_grad():
+            for window in windows:
+                prob = self.model(self.torch.from_numpy(np.ascontiguousarray(window)), self.SAMPLING_RATE).item()
+                self._add_window(prob, self.processed)
+                self.processed += self.WINDOW
+
+    def _add_window(self, prob, start):
+        # the state machine of silero's get_speech_timestamps, one window at a time
+        if prob >= self.threshold and self.temp_end:
+            self.temp_end = 0
+        if prob >= self.threshold and not self.triggered:
+            self.triggered = True
+            self.current_start = start
+            return
+        if prob < self.neg_threshold and self.triggered:
+            if not self.temp_end:
+                self.temp_end = start
+            if start - self.temp_end < self.min_silence_samples:
+                return
+            if self.temp_end - self.current_start > self.min_speech_samples:
+                self.segments.append([self.current_start, self.temp_end])
+            self.triggered = False
+            self.temp_end = 0
+
+    def speech_segments(self, sample_offset, length):
+        """speech segments within the buffer of length samples that starts at the absolute sample_offset,
+        dilated and merged, as [(beg, end), ...] in samples from the buffer start"""
+        raw = list(self.segments)
+        if self.triggered and self.processed - self.current_start > self.min_speech_samples:
+            raw.append([self.current_start, self.processed])  # the open segment
+        out = []
+        for beg, end in raw:
+            beg = max(beg - self.dilatation_samples - sample_offset, 0)
+            end = min(end + self.dilatation_samples - sample_offset, length)
+            if end <= beg:
+                continue
+            if out and beg <= out[-1][1]:
+                out[-1] = (out[-1][0], max(out[-1][1], end))
+            else:
+                out.append((beg, end))
+        return out
+
+    def remove_non_speech(self, audio, sample_offset):
+        """audio: the buffer that starts at the absolute sample_offset of the stream.
+        Returns: (speech_audio, segments in seconds of the buffer, convert function), see remove_non_speech of whisper_timestamped
+        """
+        self.update(audio, sample_offset)
+        segments = self.speech_segments(sample_offset, len(audio))
+        if segments:
+            speech = np.concatenate([audio[b:e] for b, e in segments])
+        else:
+            speech = audio[:0]
+
+        sr = self.SAMPLING_RATE
+        segments = [(b/sr, e/sr) for b, e in segments]
+        # starts of the segments in the speech-only audio
+        speech_starts = np.cumsum([0] + [e-b for b, e in segments[:-1]])
+
+        def convert(start, end=None):
+            def one(t, right):
+                if not segments:
+                    return t
+                # a timestamp on the boundary of two segments: a word start belongs to the next one, a word end to the previous one
+                i = np.searchsorted(speech_starts, t, side="left" if right else "right") - 1
+                i = min(max(i, 0), len(segments)-1)
+                return segments[i][0] + t - speech_starts[i]
+            if end is None:
+                return one(start, False)
+            return one(start, False), one(end, True)
+
+        return speech, segments, convert
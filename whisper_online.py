@@ -2,26 +2,146 @@
 import logging
 import sys
 import numpy as np
-import librosa  
 import time
-import torch
 import os
 import string 
+import inspect
+import copy
+import threading
+import queue
 
-from functools import lru_cache
+import struct
+import hashlib
+import tempfile
+import json
+from collections import OrderedDict, deque
+
+from iteration_stats import IterationStats, IterationHistograms
 
 logger = logging.getLogger(__name__)
 
-@lru_cache
+
+def _pcm16_wav_data(fname, sampling_rate=16000):
+    """Returns (offset, number of samples) of the data chunk if fname is a mono 16-bit PCM WAV file in the sampling rate, otherwise None."""
+    with open(fname, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            return None
+        fmt_ok = False
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+            if chunk_id == b"fmt ":
+                fmt = f.read(size)
+                audio_format, channels, rate, _, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+                if audio_format == 0xFFFE and len(fmt) >= 26:  # WAVE_FORMAT_EXTENSIBLE, the format is in the subformat GUID
+                    audio_format = struct.unpack("<H", fmt[24:26])[0]
+                fmt_ok = audio_format == 1 and channels == 1 and rate == sampling_rate and bits == 16
+                if size % 2:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if not fmt_ok:
+                    return None
+                offset = f.tell()
+                available = os.fstat(f.fileno()).st_size - offset
+                return offset, min(size, available) // 2
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+
+class AudioFileCache:
+    """Memory-mapped audio files for load_audio_chunk, with a bounded LRU of the open mappings.
+
+    16 kHz mono 16-bit PCM WAV files are mapped as they are. The other files are decoded once by librosa into
+    float32 .npy files in cache_dir, which are mapped then. The slices are read from the mapping, so the audio is
+    not materialised in memory and the OS can drop the pages. When the mapped files exceed max_bytes, or there are
+    more than max_files of them (every mapping keeps a file descriptor open), the least recently used ones are unmapped.
+    """
+
+    SAMPLING_RATE = 16000
+
+    def __init__(self, max_bytes=1024**3, max_files=64, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        if cache_dir is None:
+            cache_dir = os.environ.get("WHISPER_STREAMING_AUDIO_CACHE", os.path.join(tempfile.gettempdir(), "whisper_streaming_audio"))
+        self.cache_dir = cache_dir
+        self.files = OrderedDict()  # fname -> np.memmap, int16 or float32
+        self.mapped_bytes = 0
+        self.lock = threading.Lock()
+
+    def _get(self, fname):
+        # called with the lock held. The returned mapping is valid until the lock is released, a later call can
+        # close it.
+        if fname in self.files:
+            self.files.move_to_end(fname)
+            return self.files[fname]
+        audio = self._map(fname)
+        self.files[fname] = audio
+        self.mapped_bytes += audio.nbytes
+        while (self.mapped_bytes > self.max_bytes or len(self.files) > self.max_files) and len(self.files) > 1:
+            _, evicted = self.files.popitem(last=False)
+            self.mapped_bytes -= evicted.nbytes
+            self._close(evicted)
+        return audio
+
+    @staticmethod
+    def _close(audio):
+        mm = getattr(audio, "_mmap", None)
+        if mm is not None:
+            try:
+                mm.close()
+            except BufferError:
+                pass  # a view of it is still used, it is closed when it is garbage collected
+
+    def _map(self, fname):
+        wav = _pcm16_wav_data(fname, self.SAMPLING_RATE)
+        if wav is not None:
+            offset, n = wav
+            if n == 0:
+                return np.zeros(0, dtype=np.int16)
+            return np.memmap(fname, dtype="<i2", mode="r", offset=offset, shape=(n,))
+        st = os.stat(fname)
+        key = hashlib.sha1(os.path.abspath(fname).encode("utf-8")).hexdigest()
+        path = os.path.join(self.cache_dir, f"{key}_{st.st_mtime_ns}_{st.st_size}.npy")
+        if not os.path.exists(path):
+            logger.info(f"decoding {fname} into {path}")
+            import librosa  # only for the files that are not 16 kHz PCM16 WAV
+            a, _ = librosa.load(fname, sr=self.SAMPLING_RATE)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = path + f".{os.getpid()}.tmp.npy"
+            np.save(tmp, a.astype(np.float32))
+            os.replace(tmp, path)
+        return np.load(path, mmap_mode="r")
+
+    def chunk(self, fname, beg_s, end_s):
+        # copied under the lock, so that the mapping is not closed meanwhile
+        with self.lock:
+            audio = self._get(fname)[beg_s:end_s]
+            if audio.dtype == np.int16:
+                return audio.astype(np.float32) / 32768  # the same values as librosa.load returns
+            return np.array(audio, dtype=np.float32)
+
+    def duration(self, fname):
+        with self.lock:
+            return len(self._get(fname))/self.SAMPLING_RATE
+
+
+audio_files = AudioFileCache()
+
 def load_audio(fname):
-    a, _ = librosa.load(fname, sr=16000)
-    return a
+    """the whole file as a float32 array in memory, use load_audio_chunk for streaming"""
+    return audio_files.chunk(fname, 0, None)
 
 def load_audio_chunk(fname, beg, end):
-    audio = load_audio(fname)
     beg_s = int(beg*16000)
     end_s = int(end*16000)
-    return audio[beg_s:end_s]
+    return audio_files.chunk(fname, beg_s, end_s)
+
+def audio_duration(fname):
+    return audio_files.duration(fname)
 
 
 # Whisper backend
@@ -31,12 +151,16 @@ class ASRBase:
     sep = " "   # join transcribe words with this character (" " for whisper_timestamped,
                 # "" for faster-whisper because it emits the spaces when needed)
 
+    feature_extractor = None  # set by the backends whose transcribe accepts precomputed log-mel features
+
     def __init__(self, lan, modelsize=None, cache_dir=None, model_dir=None, logfile=sys.stderr, condition_on_previous_text=None, model_kwargs=None):
         self.logfile = logfile
 
         self.transcribe_kargs = {}
         self.original_language = lan 
 
+        # load_model adjusts the options, the caller's dict is not changed
+        model_kwargs = dict(model_kwargs) if model_kwargs is not None else {}
         self.model = self.load_model(modelsize, cache_dir, model_dir, model_kwargs=model_kwargs)
 
 
@@ -46,9 +170,24 @@ class ASRBase:
     def transcribe(self, audio, init_prompt=""):
         raise NotImplemented("must be implemented in the child class")
 
+    def transcribe_batch(self, audios, init_prompts):
+        """Transcribes several independent buffers, e.g. of different streams, and returns the list of their results.
+        This default runs them one by one. A backend that can run one batched encoder/decoder pass overrides it.
+        """
+        return [self.transcribe(a, init_prompt=p) for a, p in zip(audios, init_prompts)]
+
     def use_vad(self, vad_name=None):
         raise NotImplemented("must be implemented in the child class")
 
+    def for_language(self, lan):
+        """Returns a light handle that shares the loaded model, with its own language and transcribe options.
+        set_translate_task, use_vad etc. on the handle don't change this object.
+        """
+        asr = copy.copy(self)
+        asr.original_language = lan
+        asr.transcribe_kargs = dict(self.transcribe_kargs)
+        return asr
+
 
 class WhisperTimestampedASR(ASRBase):
     """Uses whisper_timestamped library as the backend. Initially, we tested the code on this backend. It worked, but slower than faster-whisper.
@@ -74,7 +213,8 @@ class WhisperTimestampedASR(ASRBase):
         self.transcribe_timestamped = transcribe_timestamped
         if model_dir is not None:
             logger.info("ignoring model_dir, not implemented")
-        if model_kwargs.get('device', "cuda")=="cpu":
+        if model_kwargs.get('device', "cuda")=="cpu" and 'cpu_threads' in model_kwargs:
+            import torch
             torch.set_num_threads(int(model_kwargs['cpu_threads']))
         model_kwargs.pop('cpu_threads', None)
         if model_kwargs.get('compute_type', None) is not None:
@@ -99,7 +239,11 @@ class WhisperTimestampedASR(ASRBase):
         o = []
         for s in r["segments"]:
             for w in s["words"]:
-                t = (w["start"],w["end"],w["text"])
+                if timestamps_convert_function is not None:
+                    start, end = timestamps_convert_function(w["start"], w["end"])
+                    t = (start, end, w["text"])
+                else:
+                    t = (w["start"],w["end"],w["text"])
                 o.append(t)
         return o
 
@@ -141,7 +285,7 @@ class FasterWhisperASR(ASRBase):
             model_size_or_path = modelsize
         else:
             raise ValueError("modelsize or model_dir parameter must be set")
-        if model_kwargs['device']=="cpu" and model_kwargs.get('compute_type', '') =="float16":
+        if model_kwargs.get('device')=="cpu" and model_kwargs.get('compute_type', '') =="float16":
             model_kwargs['compute_type'] = "int8"
             logger.info("Float16 is not supported on CPU, using INT8 instead.")
         model = WhisperModel(model_size_or_path, download_root=cache_dir, **model_kwargs)
@@ -160,11 +304,125 @@ class FasterWhisperASR(ASRBase):
         #     model = WhisperModel(model_size_or_path, device="cpu", compute_type=compute_type) #, download_root="faster-disk-cache-dir/")
         return model
 
-    def transcribe(self, audio, init_prompt=""):
+    @property
+    def feature_extractor(self):
+        if self.transcribe_kargs.get("vad_filter"):
+            return None  # the internal VAD of faster-whisper removes audio before the features are computed
+        return self.model.feature_extractor
+
+    def transcribe(self, audio, init_prompt="", features=None):
+        """features: optional log-mel features of audio, as computed by self.feature_extractor, e.g. by mel_features.MelFeatureCache"""
+        model = self.model
+        if features is not None and not self.transcribe_kargs.get("vad_filter"):
+            model = _WhisperModelView(model, _PrecomputedFeatures(model.feature_extractor, features))
         # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC, min chunk 0.01)
-        segments, info = self.model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, word_timestamps=True, **self.transcribe_kargs)
+        segments, info = type(self.model).transcribe(model, audio, language=self.original_language, initial_prompt=init_prompt, word_timestamps=True, **self.transcribe_kargs)
         return list(segments)
 
+    # the defaults of WhisperModel.transcribe
+    PREPEND_PUNCTUATIONS = "\"'“¿([{-"
+    APPEND_PUNCTUATIONS = "\"'.。,，!！?？:：”)]}、"
+    NO_SPEECH_THRESHOLD = 0.6
+    LOG_PROB_THRESHOLD = -1.0
+
+    def transcribe_batch(self, audios, init_prompts):
+        """Transcribes the buffers of several streams by one batched encoder, decoder and alignment pass of the
+        CTranslate2 model, every buffer with its own prompt (and language, if it is detected).
+
+        It is the single-window path of WhisperModel.transcribe with word timestamps, at the temperature 0 and
+        without the temperature fallback. The buffers longer than one Whisper window (30 s), and all of them
+        with the faster-whisper VAD filter or a temperature schedule, are transcribed one by one.
+        """
+        fe = self.model.feature_extractor
+        kargs = self.transcribe_kargs
+        if len(audios) < 2 or kargs.get("vad_filter") or isinstance(kargs.get("temperature", 0), (list, tuple)):
+            return super().transcribe_batch(audios, init_prompts)
+
+        results = [None]*len(audios)
+        batch = []
+        for i, a in enumerate(audios):
+            if len(a) <= fe.n_samples:
+                batch.append(i)
+            else:
+                results[i] = self.transcribe(a, init_prompt=init_prompts[i])
+        if batch:
+            for i, segments in zip(batch, self._transcribe_windows([audios[i] for i in batch], [init_prompts[i] for i in batch])):
+                results[i] = segments
+        return results
+
+    def _transcribe_windows(self, audios, init_prompts):
+        from faster_whisper.audio import pad_or_trim
+        from faster_whisper.tokenizer import Tokenizer
+        from faster_whisper.transcribe import get_suppressed_tokens, merge_punctuations
+
+        model = self.model
+        fe = model.feature_extractor
+        kargs = self.transcribe_kargs
+        task = kargs.get("task", "transcribe")
+
+        num_frames = [min(len(a) // fe.hop_length, fe.nb_max_frames) for a in audios]
+        features = np.stack([pad_or_trim(fe(a)[:, :n]) for a, n in zip(audios, num_frames)])
+        encoder_output = model.encode(features)
+
+        if self.original_language is None and model.model.is_multilingual:
+            # the most probable language of every buffer, e.g. "<|en|>"
+            languages = [r[0][0][2:-2] for r in model.model.detect_language(encoder_output)]
+        else:
+            languages = [self.original_language or "en"]*len(audios)
+        tokenizers = [Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task=task, language=lan) for lan in languages]
+
+        prompts = []
+        for tokenizer, init_prompt in zip(tokenizers, init_prompts):
+            previous_tokens = tokenizer.encode(" " + init_prompt.strip()) if init_prompt else []
+            prompts.append(model.get_prompt(tokenizer, previous_tokens))
+
+        generated = model.model.generate(
+            encoder_output, prompts,
+            beam_size=kargs.get("beam_size", 1) or 1,
+            patience=1, length_penalty=1,
+            max_length=model.max_length,
+            return_scores=True, return_no_speech_prob=True,
+            suppress_blank=True,
+            suppress_tokens=get_suppressed_tokens(tokenizers[0], [-1]),
+            max_initial_timestamp_index=50,  # 1 second
+        )
+
+        segments = []
+        for tokenizer, result, n in zip(tokenizers, generated, num_frames):
+            tokens = result.sequences_ids[0]
+            avg_logprob = result.scores[0]*len(tokens) / (len(tokens) + 1)
+            if result.no_speech_prob > self.NO_SPEECH_THRESHOLD and avg_logprob < self.LOG_PROB_THRESHOLD:
+                segments.append([])
+            else:
+                segments.append(_split_at_timestamps(tokenizer, tokens, n*fe.hop_length/fe.sampling_rate))
+
+        # the word timestamps of all the segments of a buffer by one alignment. The alignment has one start
+        # sequence for the batch, so the buffers of different detected languages are aligned in separate batches.
+        # A buffer without text is aligned with a dummy token, so that the encoder output is not split.
+        text_tokens = [[t for s in ss for t in s.tokens] for ss in segments]
+        groups = {}
+        for i, lan in enumerate(languages):
+            groups.setdefault(lan, []).append(i)
+        tokens_per_second = fe.sampling_rate / fe.hop_length / 2
+        for lan, group in groups.items():
+            if not any(text_tokens[i] for i in group):
+                continue
+            output = encoder_output if len(group) == len(audios) else model.encode(features[group])
+            alignments = model.model.align(
+                output,
+                tokenizers[group[0]].sot_sequence,
+                [text_tokens[i] or [tokenizers[i].eot] for i in group],
+                [num_frames[i] for i in group],
+                median_filter_width=7,
+            )
+            for i, alignment in zip(group, alignments):
+                if not text_tokens[i]:
+                    continue
+                words = _alignment_words(tokenizers[i], text_tokens[i], alignment, tokens_per_second)
+                merge_punctuations(words, self.PREPEND_PUNCTUATIONS, self.APPEND_PUNCTUATIONS)
+                _assign_words(segments[i], words, num_frames[i]*fe.hop_length/fe.sampling_rate)
+        return segments
+
     def ts_words(self, segments, timestamps_convert_function=None):
         o = []
         for segment in segments:
@@ -190,160 +448,847 @@ class FasterWhisperASR(ASRBase):
         self.transcribe_kargs["task"] = "translate"
 
 
+class _BatchSegment:
+    """a segment of FasterWhisperASR.transcribe_batch, with the attributes of faster_whisper's Segment that are used here"""
+
+    __slots__ = ("start", "end", "tokens", "text", "words")
+
+    def __init__(self, start, end, tokens, text):
+        self.start = start
+        self.end = end
+        self.tokens = tokens  # the text tokens, without the timestamps
+        self.text = text
+        self.words = []
+
+
+class _BatchWord:
+
+    __slots__ = ("start", "end", "word", "probability")
+
+    def __init__(self, start, end, word, probability):
+        self.start = start
+        self.end = end
+        self.word = word
+        self.probability = probability
+
+
+def _split_at_timestamps(tokenizer, tokens, duration):
+    # the generated tokens of one window -> segments between the timestamp tokens
+    segments = []
+    start = None
+    text = []
+    for t in tokens:
+        if t >= tokenizer.timestamp_begin:
+            time = (t - tokenizer.timestamp_begin)*0.02
+            if text:
+                segments.append(_BatchSegment(0.0 if start is None else start, time, text, tokenizer.decode(text)))
+                text = []
+                start = None
+            else:
+                start = time
+        elif t < tokenizer.eot:
+            text.append(t)
+    if text:  # no ending timestamp
+        segments.append(_BatchSegment(0.0 if start is None else start, duration, text, tokenizer.decode(text)))
+    return segments
+
+
+def _alignment_words(tokenizer, text_tokens, alignment, tokens_per_second):
+    # the same as WhisperModel.find_alignment, for a result of the batched alignment
+    text_indices = np.array([pair[0] for pair in alignment.alignments])
+    time_indices = np.array([pair[1] for pair in alignment.alignments])
+    words, word_tokens = tokenizer.split_to_word_tokens(text_tokens + [tokenizer.eot])
+    if len(word_tokens) <= 1:
+        return []
+    word_boundaries = np.pad(np.cumsum([len(t) for t in word_tokens[:-1]]), (1, 0))
+    jumps = np.pad(np.diff(text_indices), (1, 0), constant_values=1).astype(bool)
+    jump_times = time_indices[jumps] / tokens_per_second
+    start_times = jump_times[word_boundaries[:-1]]
+    end_times = jump_times[word_boundaries[1:]]
+    probs = alignment.text_token_probs
+    return [dict(word=w, tokens=t, start=b, end=e, probability=float(np.mean(probs[i:j])))
+            for w, t, b, e, i, j in zip(words[:-1], word_tokens[:-1], start_times, end_times, word_boundaries[:-1], word_boundaries[1:])]
+
+
+def _assign_words(segments, words, duration):
+    # the words (after merge_punctuations, which empties the merged ones) go to the segments in the order of the
+    # tokens, as in WhisperModel.add_word_timestamps
+    k = 0
+    for segment in segments:
+        n = 0
+        while k < len(words) and n < len(segment.tokens):
+            w = words[k]
+            if w["word"]:
+                segment.words.append(_BatchWord(round(float(w["start"]), 2), round(min(float(w["end"]), duration), 2), w["word"], w["probability"]))
+            n += len(w["tokens"])
+            k += 1
+        if segment.words:
+            segment.start = segment.words[0].start
+            segment.end = segment.words[-1].end
+
+
+class _PrecomputedFeatures:
+    """stands for the feature extractor of WhisperModel in one transcribe call, returns the given features"""
+
+    def __init__(self, feature_extractor, features):
+        self.feature_extractor = feature_extractor
+        self.features = features
+
+    def __getattr__(self, name):
+        return getattr(self.feature_extractor, name)
+
+    def __call__(self, waveform, *args, **kwargs):
+        return self.features
+
+
+class _WhisperModelView:
+    """WhisperModel with another feature extractor. The model is shared by the sessions, so it is not patched."""
+
+    def __init__(self, model, feature_extractor):
+        self.model = model
+        self.feature_extractor = feature_extractor
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+class ReplayASR(ASRBase):
+    """Records the results of a real ASR backend into a file, or replays them without any model.
+
+    Record mode (asr is given): every transcribe call goes to asr, and the words and segment ends of the result are
+    appended to the file, in a backend-neutral form, with the time that the call took. Replay mode (asr is None): the
+    results are read from the file and returned instantly, or after a simulated delay. OnlineASRProcessor,
+    HypothesisBuffer and the buffer trimming then run exactly as with the recorded backend, on a CPU-only machine
+    without the backend installed, e.g. for profiling or regression tests of the streaming policy.
+
+    A call is identified by the length and SHA-1 of the audio and by the prompt. The position of the buffer in the
+    stream is not passed to transcribe, but the audio and the prompt determine the result anyway. Replaying a
+    recording works only with the same audio, options and processing: e.g. with VAD, the speech-only audio depends on
+    the VAD, and the chunk sizes must be the same, which is the case for the computationally unaware simulation.
+    """
+
+    def __init__(self, path, asr=None, delay=0, strict=False, logfile=sys.stderr):
+        """path: the recording, JSON lines
+        asr: the backend to record, or None for replaying
+        delay: the simulated duration of a replayed call, in seconds, or "recorded" for the recorded duration
+        strict: raise KeyError for a call that is not in the recording, otherwise an empty result is returned
+        """
+        self.logfile = logfile
+        self.path = path
+        self.asr = asr
+        self.delay = delay
+        self.strict = strict
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if asr is not None:
+            self.sep = asr.sep
+            self.transcribe_kargs = asr.transcribe_kargs
+            self.original_language = asr.original_language
+            new = not os.path.exists(path) or os.path.getsize(path) == 0
+            self.file = open(path, "a")
+            if new:
+                self.file.write(json.dumps({"sep": self.sep}) + "\n")
+        else:
+            self.transcribe_kargs = {}
+            self.original_language = None
+            self.file = None
+            self.results = {}
+            with open(path) as f:
+                for line in f:
+                    r = json.loads(line)
+                    if "sep" in r:
+                        self.sep = r["sep"]
+                    else:
+                        self.results[(r["len"], r["sha1"], r["prompt"])] = r
+            logger.info(f"replaying {len(self.results)} ASR results from {path}")
+
+    @staticmethod
+    def key(audio, init_prompt):
+        audio = np.ascontiguousarray(audio, dtype=np.float32)
+        return (len(audio), hashlib.sha1(audio.tobytes()).hexdigest(), init_prompt)
+
+    @property
+    def feature_extractor(self):
+        # the recorded backend can use precomputed features, the results are the same
+        return None if self.asr is None else self.asr.feature_extractor
+
+    def transcribe(self, audio, init_prompt="", features=None):
+        key = self.key(audio, init_prompt)
+        if self.asr is None:
+            return self._replay(key)
+        t = time.time()
+        if features is not None:
+            res = self.asr.transcribe(audio, init_prompt=init_prompt, features=features)
+        else:
+            res = self.asr.transcribe(audio, init_prompt=init_prompt)
+        r = {"len": key[0], "sha1": key[1], "prompt": key[2], "time": time.time()-t,
+             "words": [list(w) for w in self.asr.ts_words(res)],
+             "segment_ends": list(self.asr.segments_end_ts(res))}
+        with self.lock:
+            self.file.write(json.dumps(r) + "\n")
+            self.file.flush()
+        return r
+
+    def _replay(self, key):
+        r = self.results.get(key)
+        if r is None:
+            self.misses += 1
+            if self.strict:
+                raise KeyError(f"ASR call of {key[0]} samples with prompt {key[2]!r} is not in {self.path}")
+            logger.warning(f"ASR call of {key[0]} samples is not in {self.path}, returning no words")
+            return {"words": [], "segment_ends": []}
+        self.hits += 1
+        delay = r["time"] if self.delay == "recorded" else self.delay
+        if delay:
+            time.sleep(delay)
+        return r
+
+    def ts_words(self, res, timestamps_convert_function=None):
+        # the recorded timestamps are in the transcribed audio, as the backend returned them
+        o = []
+        for b, e, w in res["words"]:
+            if timestamps_convert_function is not None:
+                b, e = timestamps_convert_function(b, e)
+            o.append((b, e, w))
+        return o
+
+    def segments_end_ts(self, res):
+        return res["segment_ends"]
+
+    def use_vad(self, vad_name=None):
+        if self.asr is not None:
+            self.asr.use_vad(vad_name)
+
+    def set_translate_task(self):
+        if self.asr is not None:
+            self.asr.set_translate_task()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class _TranscribeRequest:
+
+    def __init__(self, audio, init_prompt):
+        self.audio = audio
+        self.init_prompt = init_prompt
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchingASR:
+    """Cross-stream batching scheduler in front of one ASR object.
+
+    Several OnlineASRProcessor objects, each running process_iter in its own thread, can share it instead of the
+    ASR object itself. transcribe() enqueues the buffer and waits. One worker thread collects the requests that arrive
+    within batch_window seconds (at most max_batch_size of them) and runs them by one asr.transcribe_batch call.
+    The results go back to the waiting callers, so ts_words and HypothesisBuffer.insert of every session work as before.
+    The other attributes (sep, ts_words, segments_end_ts, ...) are taken from the wrapped ASR object.
+    """
+
+    feature_extractor = None  # precomputed features are not batched
+
+    def __init__(self, asr, max_batch_size=8, batch_window=0.05):
+        self.asr = asr
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batched_requests = 0
+
+        self.worker = threading.Thread(target=self._run, name="whisper-batching", daemon=True)
+        self.worker.start()
+
+    def __getattr__(self, name):
+        return getattr(self.asr, name)
+
+    def transcribe(self, audio, init_prompt=""):
+        request = _TranscribeRequest(audio, init_prompt)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        """stops the worker thread after the pending requests are processed"""
+        self.requests.put(None)
+        self.worker.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)  # process this batch, stop afterwards
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch = self._collect(request)
+            logger.debug(f"transcribing a batch of {len(batch)} buffers")
+            try:
+                results = self.asr.transcribe_batch([r.audio for r in batch], [r.init_prompt for r in batch])
+            except Exception as ex:
+                for r in batch:
+                    r.error = ex
+            else:
+                for r, res in zip(batch, results):
+                    r.result = res
+            self.batches += 1
+            self.batched_requests += len(batch)
+            for r in batch:
+                r.done.set()
+
+
+class CascadeASR:
+    """Overload degradation of one stream: it transcribes by the primary ASR until the stream falls behind the real
+    time, then by the fallback (a smaller model, or the same one with greedy decoding), and switches back when the
+    stream catches up.
+
+    Every OnlineASRProcessor has its own CascadeASR, the models are shared and both of them stay loaded. The driver of
+    the stream calls update(lag) after every iteration. It switches to the fallback when lag > max_lag and back when
+    lag < recover_lag, at least min_iterations after the previous switch, so that the lag of the new model is measured
+    before the next decision. Both ASR objects must be of the same backend, their results are processed by the same
+    ts_words. The precomputed features of the primary are passed to the fallback only if they fit it.
+    """
+
+    def __init__(self, primary, fallback, max_lag=3, recover_lag=1, min_iterations=3):
+        self.primary = primary
+        self.fallback = fallback
+        self.max_lag = max_lag
+        self.recover_lag = recover_lag
+        self.min_iterations = min_iterations
+        self.shared_features = _same_features(primary.feature_extractor, fallback.feature_extractor)
+        self.reset()
+
+    def reset(self):
+        """starts a new stream by the primary model"""
+        self.active = self.primary
+        self.switches = 0
+        self.iterations = 0  # since the last switch
+        self.fallback_iterations = 0
+
+    def __getattr__(self, name):
+        return getattr(self.active, name)
+
+    @property
+    def feature_extractor(self):
+        # OnlineASRProcessor computes the features once, for the primary model
+        return self.primary.feature_extractor
+
+    @property
+    def degraded(self):
+        return self.active is self.fallback
+
+    def transcribe(self, audio, init_prompt="", features=None):
+        if features is not None and (self.active is self.primary or self.shared_features):
+            return self.active.transcribe(audio, init_prompt=init_prompt, features=features)
+        return self.active.transcribe(audio, init_prompt=init_prompt)
+
+    def update(self, lag):
+        """lag: how far the end of the processed audio is behind the real time, in seconds, after an iteration.
+        Returns True if the active model was switched."""
+        self.iterations += 1
+        if self.degraded:
+            self.fallback_iterations += 1
+        if self.iterations < self.min_iterations:
+            return False
+        if not self.degraded and lag > self.max_lag:
+            self.active = self.fallback
+        elif self.degraded and lag < self.recover_lag:
+            self.active = self.primary
+        else:
+            return False
+        self.switches += 1
+        self.iterations = 0
+        logger.info(f"lag {lag:.2f}s, switching to the {'fallback' if self.degraded else 'primary'} model")
+        return True
+
+    def use_vad(self, vad_name=None):
+        self.primary.use_vad(vad_name)
+        self.fallback.use_vad(vad_name)
+
+    def set_translate_task(self):
+        self.primary.set_translate_task()
+        self.fallback.set_translate_task()
+
+
+def _same_features(a, b):
+    if a is None or b is None:
+        return False
+    if a is b:
+        return True
+    config = ("feature_size", "sampling_rate", "hop_length", "n_fft", "n_samples")
+    if getattr(a, "feature_size", None) is None:
+        return False
+    return all(getattr(a, c, None) == getattr(b, c, None) for c in config)
+
+
+def load_fallback_asr(asr, fallback_model, backend, cache_dir=None, model_kwargs=None):
+    """Returns the fallback of CascadeASR for asr, with its transcribe options (task, VAD, ...) and greedy decoding.
+    fallback_model: "greedy" for the same model, or the size of another model of the backend, loaded by the registry.
+    "greedy" is only accepted if asr decodes by beam search, otherwise the fallback would be the same as asr.
+    """
+    if fallback_model == "greedy":
+        if asr.transcribe_kargs.get("beam_size") in (None, 1):
+            raise ValueError("the fallback \"greedy\" needs a primary model with beam search, it already decodes greedily")
+        fallback = asr.for_language(asr.original_language)
+    else:
+        fallback = models.asr(backend, modelsize=fallback_model, lan=asr.original_language, cache_dir=cache_dir, model_kwargs=model_kwargs)
+        fallback.transcribe_kargs = dict(asr.transcribe_kargs)
+    if isinstance(fallback, WhisperTimestampedASR):
+        fallback.transcribe_kargs.update(beam_size=None, best_of=None, temperature=0)
+    else:
+        fallback.transcribe_kargs.update(beam_size=1, best_of=1, temperature=0)
+    return fallback
+
+
+# strips the punctuation when the words of two hypotheses are compared
+_PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+class TimedWord:
+    """a word of a hypothesis: timestamps, text, and integer ids of the text and of its normalized form"""
+
+    __slots__ = ("beg", "end", "text", "text_id", "key_id")
+
+    def __init__(self, beg, end, text, text_id, key_id):
+        self.beg = beg
+        self.end = end
+        self.text = text
+        self.text_id = text_id
+        self.key_id = key_id
+
+    def as_tuple(self):
+        return (self.beg, self.end, self.text)
+
+    def __repr__(self):
+        return repr(self.as_tuple())
+
 
 class HypothesisBuffer:
 
     def __init__(self, logfile=sys.stderr):
-        self.commited_in_buffer = []
-        self.buffer = []
-        self.new = []
+        self.commited_in_buffer = deque()
+        self.buffer = deque()
+        self.new = deque()
 
         self.last_commited_time = 0
         self.last_commited_word = None
         self.last_buffered_time = -1
 
+        # word text -> integer id, for the exact text and for the lowercased text without punctuation
+        self.token_ids = {}
+
         self.logfile = logfile
 
+    def _token_id(self, text):
+        i = self.token_ids.get(text)
+        if i is None:
+            i = self.token_ids[text] = len(self.token_ids)
+        return i
+
     def insert(self, new, offset):
         # compare self.commited_in_buffer and new. It inserts only the words in new that extend the commited_in_buffer, it means they are roughly behind last_commited_time and new in content
         # the new tail is added to self.new
-        
-        new = [(a+offset,b+offset,t) for a,b,t in new]
-        self.new = [(a,b,t) for a,b,t in new if a > self.last_commited_time-0.1]
+
+        min_beg = self.last_commited_time-0.1
+        token_id = self._token_id
+        self.new = deque(TimedWord(a+offset, b+offset, t, token_id(t), token_id(t.lower().translate(_PUNCTUATION_TABLE)))
+                         for a,b,t in new if a+offset > min_beg)
 
         if len(self.new) >= 1:
-            a,b,t = self.new[0]
-            if abs(a - self.last_commited_time) < 1:
+            if abs(self.new[0].beg - self.last_commited_time) < 1:
                 if self.commited_in_buffer:
                     # it's going to search for 1, 2, ..., 5 consecutive words (n-grams) that are identical in commited and new. If they are, they're dropped.
-                    cn = len(self.commited_in_buffer)
-                    nn = len(self.new)
-                    for i in range(1,min(min(cn,nn),5)+1):  # 5 is the maximum 
-                        c = " ".join([self.commited_in_buffer[-j][2] for j in range(1,i+1)][::-1])
-                        tail = " ".join(self.new[j-1][2] for j in range(1,i+1))
-                        if c == tail:
+                    commited, new = self.commited_in_buffer, self.new
+                    cn = len(commited)
+                    nn = len(new)
+                    for i in range(1,min(min(cn,nn),5)+1):  # 5 is the maximum
+                        if all(commited[j-i].text_id == new[j].text_id for j in range(i)):
                             logger.debug(f"removing last {i} words:")
                             for j in range(i):
-                                logger.debug(f"\t{self.new.pop(0)}")
+                                logger.debug(f"\t{new.popleft()}")
                             break
 
     def flush(self):
-        # returns commited chunk = the longest common prefix of 2 last inserts. 
+        # returns commited chunk = the longest common prefix of 2 last inserts.
 
         commit = []
-        while self.new:
-            na, nb, nt = self.new[0]
-
-            if len(self.buffer) == 0:
+        new, buffer = self.new, self.buffer
+        while new and buffer:
+            if new[0].key_id != buffer[0].key_id:
                 break
-
-            if nt.lower().translate(str.maketrans('', '', string.punctuation)) == self.buffer[0][2].lower().translate(str.maketrans('', '', string.punctuation)):                
-                commit.append((na,nb,nt))
-                self.last_commited_word = nt
-                self.last_commited_time = nb
-                self.buffer.pop(0)
-                self.new.pop(0)
-            else:
-                # print(f"SStop committing at '{nt}' and '{self.buffer[0][2]}'")
-                break
-        self.buffer = self.new
-        new_non_commit = [i for i in self.buffer if i[1] > self.last_buffered_time-0.1]
-        self.last_buffered_time = self.buffer[-1][1] if self.buffer else -1
-        self.new = []
+            w = new.popleft()
+            buffer.popleft()
+            commit.append(w)
+            self.last_commited_word = w.text
+            self.last_commited_time = w.end
+        self.buffer = new
+        new_non_commit = [w.as_tuple() for w in new if w.end > self.last_buffered_time-0.1]
+        self.last_buffered_time = new[-1].end if new else -1
+        self.new = deque()
         self.commited_in_buffer.extend(commit)
-        return commit, new_non_commit
+        return [w.as_tuple() for w in commit], new_non_commit
 
     def pop_commited(self, time):
-        while self.commited_in_buffer and self.commited_in_buffer[0][1] <= time:
-            self.commited_in_buffer.pop(0)
+        while self.commited_in_buffer and self.commited_in_buffer[0].end <= time:
+            self.commited_in_buffer.popleft()
 
     def complete(self):
-        return self.buffer
+        return [w.as_tuple() for w in self.buffer]
+
+class AudioRingBuffer:
+    """Preallocated float32 audio buffer for the streaming processor.
+
+    The samples live in self.data[self.beg:self.end]. Trimming from the front only moves self.beg (O(1)).
+    Appending copies the new chunk behind self.end; when the array is full, the live samples are moved
+    to the front, or the array is doubled if they fill more than half of it. An insert therefore costs
+    O(chunk) amortized and the array is not reallocated at all in the steady state.
+    """
+
+    def __init__(self, capacity):
+        self.data = np.empty(max(int(capacity), 1), dtype=np.float32)
+        self.beg = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.beg
+
+    def view(self):
+        """contiguous view of the buffered samples, valid until the next append"""
+        return self.data[self.beg:self.end]
+
+    def clear(self):
+        self.beg = 0
+        self.end = 0
+
+    def append(self, audio):
+        audio = np.asarray(audio, dtype=np.float32).reshape(-1)
+        n = len(audio)
+        if self.end + n > len(self.data):
+            self._make_room(n)
+        self.data[self.end:self.end+n] = audio
+        self.end += n
+
+    def trim(self, n):
+        """drops the first n samples"""
+        self.beg = min(self.beg + max(int(n), 0), self.end)
+        if self.beg == self.end:
+            self.clear()
+
+    def _make_room(self, n):
+        size = len(self)
+        capacity = len(self.data)
+        if size + n > capacity // 2:
+            while size + n > capacity // 2:
+                capacity *= 2
+            data = np.empty(capacity, dtype=np.float32)
+        else:
+            data = self.data
+        data[:size] = self.data[self.beg:self.end]  # overlapping copy is safe, beg >= 0
+        self.data = data
+        self.beg = 0
+        self.end = size
+
+
+class CommittedTranscript:
+    """The committed words of a session, [(beg,end,"word"), ...], kept in a bounded memory.
+
+    It retains the words inside of the audio buffer (after the last chunk boundary) and a window of the words before
+    the boundary that is long enough for the prompt. The older words are passed to the optional sink and forgotten.
+    The index of the chunk boundary and the length of the prompt window are maintained as the words are added and the
+    buffer is chunked, so the prompt costs the same in every iteration of a long session.
+    """
+
+    def __init__(self, prompt_chars=200, sink=None):
+        """prompt_chars: the prompt size in characters
+        sink: where the words that are not retained go: None, a file name or a file object (lines "beg end word"),
+        a callable, or a generator that receives the (beg,end,"word") tuples by send()
+        """
+        self.prompt_chars = prompt_chars
+        self.words = deque()
+        self.boundary = 0  # last_chunked_at
+        self.chunk_index = 0  # number of retained words that end before the boundary
+        self.prompt_len = 0  # characters+1 of these words
+        self.count = 0  # number of all the committed words, including the spilled ones
+
+        self.sink = None
+        self.file = None
+        self._opened_file = isinstance(sink, str)
+        if self._opened_file:
+            sink = open(sink, "a")
+        if hasattr(sink, "write"):
+            self.file = sink
+            self.sink = lambda w: self.file.write(f"{w[0]:1.3f} {w[1]:1.3f} {w[2]}\n")
+        elif hasattr(sink, "send"):
+            if inspect.getgeneratorstate(sink) == inspect.GEN_CREATED:
+                next(sink)  # start the generator
+            self.sink = sink.send
+        elif callable(sink):
+            self.sink = sink
+        self.closed = False
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, i):
+        return self.words[i]
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def extend(self, words):
+        self.words.extend(words)
+        self.count += len(words)
+        self._advance()
+
+    def chunk_at(self, time):
+        self.boundary = time
+        self._advance()
+
+    def _advance(self):
+        words = self.words
+        while self.chunk_index < len(words) and words[self.chunk_index][1] <= self.boundary:
+            self.prompt_len += len(words[self.chunk_index][2])+1
+            self.chunk_index += 1
+        # the prompt is taken from the end of words[:chunk_index] (or of words[:chunk_index-1], see prompt),
+        # the first word is not needed if the words after it, without the last one, are long enough
+        while self.chunk_index > 2:
+            first = len(words[0][2])+1
+            if self.prompt_len - first - (len(words[self.chunk_index-1][2])+1) < self.prompt_chars:
+                break
+            w = words.popleft()
+            self.chunk_index -= 1
+            self.prompt_len -= first
+            if self.sink is not None:
+                self.sink(w)
+
+    def prompt(self):
+        """Returns: (prompt words, context words). The prompt words are at most prompt_chars-character suffix of
+        the words before the boundary, the context words are after it."""
+        # the last committed word is never in the prompt
+        k = min(self.chunk_index, max(0, len(self.words)-1))
+        prompt = []
+        l = 0
+        while k > len(prompt) and l < self.prompt_chars:
+            x = self.words[k-1-len(prompt)][2]
+            l += len(x)+1
+            prompt.append(x)
+        context = [self.words[i][2] for i in range(k, len(self.words))]
+        return prompt[::-1], context
+
+    def close(self):
+        """passes all the retained words to the sink, at the end of the session"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.sink is not None:
+            for w in self.words:
+                self.sink(w)
+        if self._opened_file:
+            self.file.close()
+        elif self.file is not None:
+            self.file.flush()
+
+
+class SentenceSegmenter:
+    """Incremental sentence segmentation of the committed words, for the "sentence" buffer trimming.
+
+    All the sentences but the last one that the tokenizer finds in the committed text are finished: the words
+    committed later can't change them. Their boundaries are kept, and only the unfinished tail -- the words after the
+    last finished sentence -- is segmented again when new words are committed. The cost of one update is proportional
+    to the tail, not to the whole transcript.
+    """
+
+    def __init__(self, tokenizer, keep=2):
+        """tokenizer: the sentence tokenizer with the method *split*
+        keep: how many finished sentences to remember
+        """
+        self.tokenizer = tokenizer
+        self.finished = deque(maxlen=keep)  # [(beg,end,"sentence"), ...]
+        self.tail = []  # the committed words after the last finished sentence
+        self.last = None  # the unfinished last sentence of the tail, from the last update
+
+    def extend(self, words):
+        self.tail.extend(words)
+
+    def update(self):
+        """segments the tail. Returns: the remembered finished sentences and the unfinished one, [(beg,end,"sentence"), ...]"""
+        sents = words_to_sentences(self.tokenizer, self.tail)
+        if len(sents) > 1:
+            self.finished.extend(sents[:-1])
+            end = sents[-2][1]
+            self.chunk_at(end)
+        self.last = sents[-1] if sents else None
+        return self.sentences()
+
+    def chunk_at(self, time):
+        """drops the tail words that end at or before time. The audio buffer is trimmed there, so no sentence can end
+        before it, and the tail of an unpunctuated transcript doesn't grow with the whole stream."""
+        i = 0
+        while i < len(self.tail) and self.tail[i][1] <= time:
+            i += 1
+        del self.tail[:i]
+
+    def sentences(self):
+        out = list(self.finished)
+        if self.last is not None:
+            out.append(self.last)
+        return out
+
 
 class OnlineASRProcessor:
 
     SAMPLING_RATE = 16000
 
-    def __init__(self, asr, tokenizer=None, buffer_trimming=("segment", 15), logfile=sys.stderr):
+    def __init__(self, asr, tokenizer=None, buffer_trimming=("segment", 15), logfile=sys.stderr, vad=True, commit_sink=None):
         """asr: WhisperASR object
         tokenizer: sentence tokenizer object for the target language. Must have a method *split* that behaves like the one of MosesTokenizer. It can be None, if "segment" buffer trimming option is used, then tokenizer is not used at all.
         ("segment", 15)
         buffer_trimming: a pair of (option, seconds), where option is either "sentence" or "segment", and seconds is a number. Buffer is trimmed if it is longer than "seconds" threshold. Default is the most recommended option.
-        logfile: where to store the log. 
+        logfile: where to store the log.
+        vad: filter out the non-speech audio by Silero VAD before transcribing. The VAD processes only the newly inserted audio in every iteration.
+            Without it (--processor-vad off), the whole buffer is transcribed, and the backends that accept log-mel features get them from MelFeatureCache.
+        commit_sink: where the old committed words go, see CommittedTranscript. Only the words needed for the prompt and the current buffer are kept in memory.
         """
         self.asr = asr
+        self.commit_sink = commit_sink
+        self.iteration_hooks = []  # see add_iteration_hook
         self.tokenizer = tokenizer
         self.logfile = logfile
 
+        self.buffer_trimming_way, self.buffer_trimming_sec = buffer_trimming
+
+        # the buffer is trimmed at buffer_trimming_sec (segment) or at 30 seconds (sentence), twice that
+        # leaves enough headroom so that the array is normally allocated once per processor
+        max_buffer_sec = self.buffer_trimming_sec if self.buffer_trimming_way == "segment" else 30
+        self._audio = AudioRingBuffer(2*(max_buffer_sec+1)*self.SAMPLING_RATE)
+
+        # log-mel features of the buffer kept between the iterations, for the backends that accept them. Only without
+        # the VAD, which transcribes the speech audio and not the buffer, and the cut of the buffer stays exact then.
+        if not vad and asr.feature_extractor is not None:
+            from mel_features import MelFeatureCache
+            self.mel_cache = MelFeatureCache(asr.feature_extractor)
+        else:
+            self.mel_cache = None
+
+        if vad:
+            from streaming_vad import StreamingVAD
+            self.vad = StreamingVAD(dilatation=0.5)
+        else:
+            self.vad = None
+
         self.init()
 
-        self.buffer_trimming_way, self.buffer_trimming_sec = buffer_trimming
+    @property
+    def audio_buffer(self):
+        """the current audio buffer, a contiguous view that is valid until the next insert_audio_chunk"""
+        return self._audio.view()
 
     def init(self):
         """run this when starting or restarting processing"""
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self._audio.clear()
         self.buffer_time_offset = 0
+        self.buffer_sample_offset = 0  # the same as buffer_time_offset, in samples from the beginning of the stream
+        if self.mel_cache is not None:
+            self.mel_cache.reset()
+        if self.vad is not None:
+            self.vad.reset()
 
         self.transcript_buffer = HypothesisBuffer(logfile=self.logfile)
-        self.commited = []
+        if getattr(self, "commited", None) is not None:
+            self.commited.close()
+        self.commited = CommittedTranscript(sink=self.commit_sink)
         self.last_chunked_at = 0
+        self.segmenter = SentenceSegmenter(self.tokenizer) if self.buffer_trimming_way == "sentence" else None
 
-        self.silence_iters = 0
+        self.silence_iters = 0  # consecutive iterations without speech in the new audio
+        self.iterations = 0
+        self.skipped_iters = 0  # iterations without the ASR call, see process_iter
+        self.last_iter_end = 0  # absolute sample where the audio buffer ended in the last iteration
+        self.last_incomplete = (None, None, "")
+
+        self.stats = IterationHistograms()  # per-stage timings of the iterations of this stream
+        self.iteration = None  # IterationStats of the running process_iter
 
     def insert_audio_chunk(self, audio):
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        self._audio.append(audio)
 
     def prompt(self):
         """Returns a tuple: (prompt, context), where "prompt" is a 200-character suffix of commited text that is inside of the scrolled away part of audio buffer. 
         "context" is the commited text that is inside the audio buffer. It is transcribed again and skipped. It is returned only for debugging and logging reasons.
         """
-        k = max(0,len(self.commited)-1)
-        while k > 0 and self.commited[k-1][1] > self.last_chunked_at:
-            k -= 1
-
-        p = self.commited[:k]
-        p = [t for _,_,t in p]
-        prompt = []
-        l = 0
-        while p and l < 200:  # 200 characters prompt size
-            x = p.pop(-1)
-            l += len(x)+1
-            prompt.append(x)
-        non_prompt = self.commited[k:]
-        return self.asr.sep.join(prompt[::-1]), self.asr.sep.join(t for _,_,t in non_prompt)
+        prompt, non_prompt = self.commited.prompt()  # 200 characters prompt size
+        return self.asr.sep.join(prompt), self.asr.sep.join(non_prompt)
 
     def process_iter(self):
         """Runs on the current audio buffer.
         Returns: a tuple (beg_timestamp, end_timestamp, "text"), or (None, None, ""). 
         The non-emty text is confirmed (committed) partial transcript.
         """
-        vad = True
+        self.iterations += 1
+        stats = self.iteration = IterationStats(self.iterations, self.buffer_time_offset, len(self.audio_buffer)/self.SAMPLING_RATE)
+        vad = self.vad is not None
         prompt, non_prompt = self.prompt()
         logger.debug(f"PROMPT:{prompt}")
         logger.debug(f"CONTEXT:{non_prompt}")
         logger.debug(f"Transcribing {len(self.audio_buffer)/self.SAMPLING_RATE:2.2f} seconds starting at {self.buffer_time_offset:2.2f}s")
         # print(f"Transcribing {len(self.audio_buffer)/self.SAMPLING_RATE:2.2f} seconds starting at {self.buffer_time_offset:2.2f}s")
+        stats.lap("prompt")
         # use VAD to filter out the silence
         if vad:
-            from whisper_timestamped.transcribe import remove_non_speech
-            tensor_buffer = torch.tensor(self.audio_buffer)
-            audio_speech, segments, convertion_function = remove_non_speech(tensor_buffer, method="silero", sample_rate=self.SAMPLING_RATE, dilatation=0.5)
-            audio_speech = audio_speech.numpy()
+            # only the audio appended since the last iteration goes through the VAD model
+            audio_speech, segments, convertion_function = self.vad.remove_non_speech(self.audio_buffer, self.buffer_sample_offset)
+            stats.lap("vad")
+            if self.skip_silent_iteration(segments):
+                stats.skipped = True
+                stats.lap("trim")
+                self._end_iteration(stats)
+                return (None, None, ""), self.last_incomplete
             res = self.asr.transcribe(audio_speech, init_prompt=prompt)
+        elif self.mel_cache is not None:
+            features = self.mel_cache.features(self.audio_buffer, self.buffer_sample_offset)
+            stats.lap("features")
+            res = self.asr.transcribe(self.audio_buffer, init_prompt=prompt, features=features)
         else:
             res = self.asr.transcribe(self.audio_buffer, init_prompt=prompt)
+        stats.lap("transcribe")
         # transform to [(beg,end,"word1"), ...]
         tsw = self.asr.ts_words(res, convertion_function if vad else None)
         # print(f"TSW: {tsw}")
+        stats.lap("ts_words")
 
         self.transcript_buffer.insert(tsw, self.buffer_time_offset)
+        stats.lap("insert")
         o, buffer = self.transcript_buffer.flush()
         self.commited.extend(o)
+        if self.segmenter is not None:
+            self.segmenter.extend(o)
+        stats.committed_words = len(o)
         # print(f"{buffer}")
         if buffer and (self.buffer_time_offset+len(self.audio_buffer)/self.SAMPLING_RATE)-buffer[-1][1]<0.05:
             buffer.pop(-1)
         logger.debug(f">>>>COMPLETE NOW:{self.to_flush(o)}")
         logger.debug(f"INCOMPLETE:{self.to_flush(self.transcript_buffer.complete())}")
+        stats.lap("flush")
 
         # there is a newly confirmed text
 
@@ -371,18 +1316,53 @@ class OnlineASRProcessor:
             #self.chunk_at(t)
 
         logger.debug(f"len of buffer now: {len(self.audio_buffer)/self.SAMPLING_RATE:2.2f}")
-        return self.to_flush(o), self.to_flush(buffer)
+        self.last_incomplete = self.to_flush(buffer)
+        stats.lap("trim")
+        self._end_iteration(stats)
+        return self.to_flush(o), self.last_incomplete
+
+    def add_iteration_hook(self, hook):
+        """hook: a function that is called with the iteration_stats.IterationStats record at the end of every
+        process_iter call, in the thread that runs it. It should be fast, it delays the result."""
+        self.iteration_hooks.append(hook)
+
+    def _end_iteration(self, stats):
+        stats.finish()
+        self.iteration = None
+        self.stats.add(stats)
+        for hook in self.iteration_hooks:
+            hook(stats)
+
+    def skip_silent_iteration(self, speech_segments):
+        """Decides whether the ASR call of this iteration can be skipped, and if so, only trims the buffer.
+        It is skipped if the audio inserted since the last iteration contains no speech, and there was already one
+        iteration with no new speech, so that the hypothesis of the last speech had a chance to be confirmed.
+        speech_segments: the VAD segments of the buffer, in seconds of the buffer
+        """
+        buffer_end = self.buffer_sample_offset + len(self.audio_buffer)
+        new_beg = (self.last_iter_end - self.buffer_sample_offset)/self.SAMPLING_RATE
+        self.last_iter_end = buffer_end
+        if any(e > new_beg for _, e in speech_segments):
+            self.silence_iters = 0
+            return False
+        self.silence_iters += 1
+        if self.silence_iters < 2:
+            return False
+
+        self.skipped_iters += 1
+        logger.debug(f"no new speech, skipping the ASR ({self.skipped_iters}/{self.iterations} iterations skipped)")
+        s = self.buffer_trimming_sec if self.buffer_trimming_way == "segment" else 30
+        if len(self.audio_buffer)/self.SAMPLING_RATE > s:
+            self.chunk_completed_segment(None, chunk_silence=True, speech_segments=speech_segments)
+        return True
 
     def chunk_completed_sentence(self):
-        if self.commited == []: return
-        logger.info(self.commited)
-        sents = self.words_to_sentences(self.commited)
+        if len(self.commited) == 0: return
+        sents = self.segmenter.update()  # segments only the words after the last finished sentence
         for s in sents:
-            logger.debug("\t\tSENT:",s)
+            logger.debug(f"\t\tSENT: {s}")
         if len(sents) < 2:
             return
-        while len(sents) > 2:
-            sents.pop(0)
         # we will continue with audio processing at this timestamp
         chunk_at = sents[-2][1]
 
@@ -390,11 +1370,11 @@ class OnlineASRProcessor:
         self.chunk_at(chunk_at)
 
     def chunk_completed_segment(self, res, chunk_silence=False, speech_segments=None):
-        if self.commited == [] and not chunk_silence: 
+        if len(self.commited) == 0 and not chunk_silence:
             return
 
-        ends = self.asr.segments_end_ts(res)
-        t = self.commited[-1][1]
+        ends = self.asr.segments_end_ts(res) if res is not None else []
+        t = self.commited[-1][1] if self.commited else self.buffer_time_offset
         if len(ends) > 1:
             e = ends[-2]+self.buffer_time_offset
             while len(ends) > 2 and e > t:
@@ -429,36 +1409,29 @@ class OnlineASRProcessor:
         """
         # print(f"chunking at {time:2.2f}")
         self.transcript_buffer.pop_commited(time)
+        self.commited.chunk_at(time)
+        if self.segmenter is not None:
+            self.segmenter.chunk_at(time)
         cut_seconds = time - self.buffer_time_offset
-        self.audio_buffer = self.audio_buffer[int(cut_seconds*self.SAMPLING_RATE):]
-        self.buffer_time_offset = time
+        cut = max(int(cut_seconds*self.SAMPLING_RATE), 0)
+        if self.mel_cache is not None:
+            # cut on the feature frame grid (10 ms, below Whisper's timestamp resolution) so that the cached frames stay valid
+            cut -= (self.buffer_sample_offset + cut) % self.mel_cache.hop_length
+            self.mel_cache.trim(self.buffer_sample_offset + cut)
+        self._audio.trim(cut)
+        self.buffer_sample_offset += cut
+        if self.vad is not None:
+            self.vad.trim(self.buffer_sample_offset)
+        self.buffer_time_offset = time if self.mel_cache is None else self.buffer_sample_offset/self.SAMPLING_RATE
         self.last_chunked_at = time
+        if self.iteration is not None:
+            self.iteration.trims.append((time, cut/self.SAMPLING_RATE))
 
     def words_to_sentences(self, words):
         """Uses self.tokenizer for sentence segmentation of words.
         Returns: [(beg,end,"sentence 1"),...]
         """
-        
-        cwords = [w for w in words]
-        t = " ".join(o[2] for o in cwords)
-        s = self.tokenizer.split(t)
-        out = []
-        while s:
-            beg = None
-            end = None
-            sent = s.pop(0).strip()
-            fsent = sent
-            while cwords:
-                b,e,w = cwords.pop(0)
-                w = w.strip()
-                if beg is None and sent.startswith(w):
-                    beg = b
-                elif end is None and sent == w:
-                    end = e
-                    out.append((beg,end,fsent))
-                    break
-                sent = sent[len(w):].strip()
-        return out
+        return words_to_sentences(self.tokenizer, words)
 
     def finish(self):
         """Flush the incomplete text when the whole processing ends.
@@ -467,6 +1440,7 @@ class OnlineASRProcessor:
         o = self.transcript_buffer.complete()
         f = self.to_flush(o)
         logger.debug(f"last, noncommited:{f}")
+        self.commited.close()
         return f
 
 
@@ -487,8 +1461,39 @@ class OnlineASRProcessor:
 
 WHISPER_LANG_CODES = "af,am,ar,as,az,ba,be,bg,bn,bo,br,bs,ca,cs,cy,da,de,el,en,es,et,eu,fa,fi,fo,fr,gl,gu,ha,haw,he,hi,hr,ht,hu,hy,id,is,it,ja,jw,ka,kk,km,kn,ko,la,lb,ln,lo,lt,lv,mg,mi,mk,ml,mn,mr,ms,mt,my,ne,nl,nn,no,oc,pa,pl,ps,pt,ro,ru,sa,sd,si,sk,sl,sn,so,sq,sr,su,sv,sw,ta,te,tg,th,tk,tl,tr,tt,uk,ur,uz,vi,yi,yo,zh".split(",")
 
-def create_tokenizer(lan):
-    """returns an object that has split function that works like the one of MosesTokenizer"""
+def words_to_sentences(tokenizer, words):
+    """Segments words [(beg,end,"word"), ...] into sentences by tokenizer.split.
+    Returns: [(beg,end,"sentence 1"),...]
+    """
+    t = " ".join(o[2] for o in words)
+    out = []
+    i = 0
+    for sent in tokenizer.split(t):
+        beg = None
+        end = None
+        sent = sent.strip()
+        fsent = sent
+        while i < len(words):
+            b,e,w = words[i]
+            i += 1
+            w = w.strip()
+            if beg is None and sent.startswith(w):
+                beg = b
+            elif end is None and sent == w:
+                end = e
+                out.append((beg,end,fsent))
+                break
+            sent = sent[len(w):].strip()
+    return out
+
+
+MOSES_LANGUAGES = "as bn ca cs de el en es et fi fr ga gu hi hu is it kn lt lv ml mni mr nl or pa pl pt ro ru sk sl sv ta te yue zh".split()
+WTP_MODEL = "wtp-canine-s-12l-no-adapters"
+
+def create_tokenizer(lan, wtp=None):
+    """returns an object that has split function that works like the one of MosesTokenizer
+    wtp: the loaded WtP model for the languages that are segmented by wtpsplit, it is loaded if None
+    """
 
     assert lan in WHISPER_LANG_CODES, "language must be Whisper's supported lang code: " + " ".join(WHISPER_LANG_CODES)
 
@@ -500,24 +1505,238 @@ def create_tokenizer(lan):
         return UkrainianTokenizer()
 
     # supported by fast-mosestokenizer
-    if lan in "as bn ca cs de el en es et fi fr ga gu hi hu is it kn lt lv ml mni mr nl or pa pl pt ro ru sk sl sv ta te yue zh".split():
+    if lan in MOSES_LANGUAGES:
         from mosestokenizer import MosesTokenizer
         return MosesTokenizer(lan)
 
     # the following languages are in Whisper, but not in wtpsplit:
     if lan in "as ba bo br bs fo haw hr ht jw lb ln lo mi nn oc sa sd sn so su sw tk tl tt".split():
-        logger.warning(f"{lan} code is not supported by wtpsplit. Going to use None lang_code option.", file=sys.stderr)
+        logger.warning(f"{lan} code is not supported by wtpsplit. Going to use None lang_code option.")
         lan = None
 
-    from wtpsplit import WtP
-    # downloads the model from huggingface on the first use
-    wtp = WtP("wtp-canine-s-12l-no-adapters")
+    if wtp is None:
+        wtp = _load_wtp()
     class WtPtok:
         def split(self, sent):
             return wtp.split(sent, lang_code=lan)
     return WtPtok()
 
 
+class _RegistryEntry:
+
+    def __init__(self, value, dependencies=()):
+        self.value = value
+        self.dependencies = list(dependencies)  # handles of other entries, released when this one is unloaded
+        self.references = 0
+        self.released = time.time()
+
+
+class ModelRegistry:
+    """Process-wide registry of the loaded Whisper models and sentence segmenters.
+
+    Every model is loaded once per key and shared by all the processors that acquire it, e.g. by the sessions of the
+    server or by the files of a benchmark. The Whisper weights are keyed by (backend, model, device, compute_type,
+    cpu_threads). The language and the task are decoding options, so asr() returns a light handle of the shared
+    model with its own options (see ASRBase.for_language). The tokenizers are keyed by language and share one WtP
+    model.
+
+    The entries are reference counted, release() returns a handle. An unused entry stays loaded for the next
+    acquire, or, if idle_timeout is set, it is unloaded when it was unused for idle_timeout seconds.
+    """
+
+    def __init__(self, idle_timeout=None):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.RLock()
+        self.entries = {}  # key -> _RegistryEntry
+        self.handles = {}  # id(handle) -> [key, handle, number of the acquires not released yet]
+        self.loads = 0
+
+    def acquire(self, key, load, handle=None, dependencies=()):
+        """Returns the object of key, loaded by load() if it is not loaded yet, and counts a reference to it.
+        handle: a function that makes the returned handle from the shared object, the object itself by default
+        """
+        with self.lock:
+            self.evict_idle()
+            entry = self.entries.get(key)
+            if entry is None:
+                t = time.time()
+                entry = self.entries[key] = _RegistryEntry(load(), dependencies)
+                self.loads += 1
+                logger.info(f"loaded {key} in {time.time()-t:.2f}s")
+            entry.references += 1
+            h = entry.value if handle is None else handle(entry.value)
+            self.handles.setdefault(id(h), [key, h, 0])[2] += 1
+            return h
+
+    def release(self, handle):
+        with self.lock:
+            record = self.handles[id(handle)]
+            record[2] -= 1
+            if record[2] == 0:
+                del self.handles[id(handle)]
+            entry = self.entries[record[0]]
+            entry.references -= 1
+            entry.released = time.time()
+            self.evict_idle()
+
+    def evict_idle(self, now=None):
+        """unloads the entries that were unused for idle_timeout seconds"""
+        if self.idle_timeout is None:
+            return
+        now = time.time() if now is None else now
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if key in self.entries and entry.references == 0 and now - entry.released >= self.idle_timeout:
+                    logger.info(f"unloading {key}, unused for {now-entry.released:.0f}s")
+                    del self.entries[key]
+                    for dependency in entry.dependencies:
+                        self.release(dependency)
+
+    def asr(self, backend, modelsize=None, lan=None, cache_dir=None, model_dir=None, model_kwargs=None, logfile=sys.stderr):
+        """Returns a handle of the Whisper model for the language lan.
+        backend: "faster-whisper", "whisper_timestamped-openai" or "whisper_timestamped-transformers", see add_shared_args
+        """
+        model_kwargs = dict(model_kwargs) if model_kwargs is not None else {}
+        if backend == "faster-whisper":
+            asr_cls = FasterWhisperASR
+        else:
+            asr_cls = WhisperTimestampedASR
+            model_kwargs.setdefault('backend', "transformers" if backend == "whisper_timestamped-transformers" else "openai-whisper")
+        # the number of CPU threads is fixed when the model is loaded
+        key = (backend, model_dir or modelsize, model_kwargs.get('device'), model_kwargs.get('compute_type'), model_kwargs.get('cpu_threads'))
+        def load():
+            return asr_cls(lan, modelsize=modelsize, cache_dir=cache_dir, model_dir=model_dir, logfile=logfile, model_kwargs=model_kwargs)
+        return self.acquire(key, load, handle=lambda asr: asr.for_language(lan))
+
+    def tokenizer(self, lan):
+        """Returns the sentence tokenizer for the language lan, see create_tokenizer"""
+        key = ("tokenizer", lan)
+        with self.lock:
+            if key in self.entries or lan == "uk" or lan in MOSES_LANGUAGES:
+                return self.acquire(key, lambda: create_tokenizer(lan))
+            wtp = self.acquire(("wtp", WTP_MODEL), _load_wtp)
+            return self.acquire(key, lambda: create_tokenizer(lan, wtp=wtp), dependencies=[wtp])
+
+
+def _load_wtp():
+    from wtpsplit import WtP
+    # downloads the model from huggingface on the first use
+    return WtP(WTP_MODEL)
+
+
+# the registry of this process
+models = ModelRegistry()
+
+
+def synthetic_speech(seconds, sampling_rate=16000, seed=0):
+    """Deterministic speech-like audio for warming up: a voiced sound with a gliding pitch, its harmonics and
+    syllable-rate amplitude modulation, plus a little noise. It is not speech, but it exercises the same code."""
+    t = np.arange(int(seconds*sampling_rate)) / sampling_rate
+    pitch = 120 + 40*np.sin(2*np.pi*0.5*t)
+    phase = 2*np.pi*np.cumsum(pitch) / sampling_rate
+    voiced = sum(np.sin(k*phase)/k for k in range(1, 8))
+    envelope = 0.5 + 0.5*np.sin(2*np.pi*4*t)
+    noise = np.random.default_rng(seed).standard_normal(len(t))
+    return (0.1*envelope*voiced + 0.005*noise).astype(np.float32)
+
+
+def warm_up(new_online_processor, min_chunk_size, max_buffer_sec, logfile=sys.stderr):
+    """Warms up the model, VAD and allocators before the first real audio: the very first transcribe of each buffer
+    length takes much more time than the next ones.
+    new_online_processor: a function that returns an OnlineASRProcessor with the same options as the real ones
+    The generated audio is fed so that the buffer is min_chunk_size seconds long, then twice as long etc. up to
+    max_buffer_sec, and every buffer goes through process_iter and also directly through the ASR (process_iter can
+    skip the ASR when the VAD finds no speech). Returns the warm-up time in seconds.
+    """
+    t = time.time()
+    online = new_online_processor()
+    audio = synthetic_speech(max_buffer_sec)
+    sr = online.SAMPLING_RATE
+    end = 0
+    while end < len(audio):
+        beg, end = end, min(max(2*end, int(min_chunk_size*sr), 1), len(audio))
+        online.insert_audio_chunk(audio[beg:end])
+        online.process_iter()
+        online.asr.transcribe(audio[:end])
+        logger.debug(f"warm-up with {end/sr:.2f}s buffer")
+    online.finish()
+    return time.time() - t
+
+
+class VirtualClock:
+    """The clock of the real-time simulation that skips the waiting for the audio.
+
+    sleep() moves the clock forward instead of sleeping, the time spent by processing passes as on the wall clock. The
+    chunk boundaries, emission times and latencies are then the same as in the real-time simulation, but a long file
+    is processed as fast as the machine computes. It has the time() and sleep() of the time module.
+    """
+
+    def __init__(self):
+        self.skipped = 0  # the sum of the skipped sleeps
+
+    def time(self):
+        return time.time() + self.skipped
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.skipped += seconds
+
+
+class AdaptiveChunkController:
+    """Adjusts min_chunk_size after every iteration so that the latency stays near target_latency.
+
+    A word is confirmed by the local agreement of two iterations, so its latency is roughly two chunks plus the
+    processing time of an iteration. The controller keeps a moving average of the processing time p and sets the
+    chunk to (target_latency - p)/2, within [min_chunk, max_chunk]. The chunk is never shorter than p: a shorter
+    one can't be processed in time anyway, the next chunk is as long as the processing, and the additional
+    iterations only waste compute. When the processing falls behind the real time by more than its own duration,
+    this lag is counted as the processing time.
+
+    With online, the controller also adapts its buffer_trimming_sec: the processing time grows with the buffer, so
+    the buffer is trimmed earlier when the target is not reachable (3*p > target_latency), and the threshold goes back
+    up to the original value when the processing is fast (6*p < target_latency).
+    """
+
+    def __init__(self, target_latency, min_chunk_size, min_chunk=0.1, max_chunk=None, online=None,
+                 min_buffer_trimming_sec=2, smoothing=0.3):
+        self.target_latency = target_latency
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk if max_chunk is not None else target_latency/2
+        self.smoothing = smoothing
+        self.chunk_size = min(max(min_chunk_size, self.min_chunk), self.max_chunk)
+        self.processing_time = None  # the moving average
+
+        self.online = online
+        if online is not None:
+            self.max_buffer_trimming_sec = online.buffer_trimming_sec
+            self.min_buffer_trimming_sec = min(min_buffer_trimming_sec, online.buffer_trimming_sec)
+
+    def update(self, processing_time, lag=0):
+        """processing_time: of the last iteration, lag: the time since the end of its audio, if known.
+        Returns the new chunk size."""
+        p = max(processing_time, lag)
+        if self.processing_time is None:
+            self.processing_time = p
+        else:
+            self.processing_time += self.smoothing*(p - self.processing_time)
+        p = self.processing_time
+
+        chunk = max((self.target_latency - p)/2, p)
+        self.chunk_size = min(max(chunk, self.min_chunk), self.max_chunk)
+
+        if self.online is not None:
+            trimming = self.online.buffer_trimming_sec
+            if 3*p > self.target_latency:
+                trimming = max(0.9*trimming, self.min_buffer_trimming_sec)
+            elif 6*p < self.target_latency:
+                trimming = min(1.1*trimming, self.max_buffer_trimming_sec)
+            if trimming != self.online.buffer_trimming_sec:
+                logger.debug(f"buffer trimming {trimming:.2f}s")
+                self.online.buffer_trimming_sec = trimming
+        logger.debug(f"processing {p:.2f}s, chunk size {self.chunk_size:.2f}s")
+        return self.chunk_size
+
+
 def add_shared_args(parser):
     """shared args for simulation (this entry point) and server
     parser: argparse.ArgumentParser object
@@ -531,8 +1750,14 @@ def add_shared_args(parser):
     parser.add_argument('--task', type=str, default='transcribe', choices=["transcribe","translate"],help="Transcribe or translate.")
     parser.add_argument('--backend', type=str, default="faster-whisper", choices=["faster-whisper", "whisper_timestamped-openai", "whisper_timestamped-transformers"],help='Load only this backend for Whisper processing.')
     parser.add_argument('--vad', action='store', default=False, const=True, nargs='?', help='Use VAD = voice activity detection, with the default parameters.')
+    parser.add_argument('--processor-vad', type=str, default=None, choices=["on", "off"], help='Silero VAD of OnlineASRProcessor, which removes the non-speech audio before transcribing (default: on, off with --record and --replay of whisper_online_full_options.py). It is independent of --vad of the backend. "off" transcribes the whole buffer, which lets faster-whisper reuse the log-mel features of the previous iteration, and it does not import torch.')
     parser.add_argument('--buffer_trimming', type=str, default="segment", choices=["sentence", "segment"],help='Buffer trimming strategy -- trim completed sentences marked with punctuation mark and detected by sentence segmenter, or the completed segments returned by Whisper. Sentence segmenter must be installed for "sentence" option.')
     parser.add_argument('--buffer_trimming_sec', type=float, default=8, help='Buffer trimming length threshold in seconds. If buffer length is longer, trimming sentence/segment is triggered.')
+    parser.add_argument('--target-latency', type=float, default=None, help='Adapt the chunk size after every iteration to hold this latency in seconds, see AdaptiveChunkController. --min-chunk-size is then the initial chunk size. It applies to the real-time simulation and the server.')
+    parser.add_argument('--fallback-model', type=str, default=None, help='Overload degradation: a session that falls behind the real time by more than --fallback-lag seconds is transcribed by this model until it catches up, see CascadeASR. A model size of the same backend, or "greedy" for the same model with greedy decoding, if it decodes by beam search (--method beam-search of whisper_online_full_options.py). Both models stay loaded.')
+    parser.add_argument('--fallback-lag', type=float, default=3, help='Switch to --fallback-model when the processing is behind the real time by more than this many seconds.')
+    parser.add_argument('--recover-lag', type=float, default=1, help='Switch back from --fallback-model when the lag is below this many seconds.')
+    parser.add_argument('--adaptive-trimming', action="store_true", default=False, help='With --target-latency, also lower --buffer_trimming_sec when the target is not reachable, and raise it back to the original value when the processing is fast.')
 
 
 
@@ -571,9 +1796,16 @@ if __name__ == "__main__":
     parser.add_argument('--start_at', type=float, default=0.0, help='Start processing audio at this time.')
     parser.add_argument('--offline', action="store_true", default=False, help='Offline mode.')
     parser.add_argument('--comp_unaware', action="store_true", default=False, help='Computationally unaware simulation.')
+    parser.add_argument('--virtual_clock', action="store_true", default=False, help='Real-time simulation with a virtual clock: the time spent by processing passes, the waiting for the audio is skipped. The emission times and latencies are as in the default mode, but it runs as fast as the processing.')
+    parser.add_argument('--profile-startup', action="store_true", default=False, help='Report the import time of the modules imported while loading the model, and the peak memory.')
     
     args = parser.parse_args()
 
+    if args.profile_startup:
+        from startup_profile import ImportProfiler
+        import_profiler = ImportProfiler()
+        import_profiler.start()
+
     # reset to store stderr to different file stream, e.g. open(os.devnull,"w")
     logfile = sys.stderr
 
@@ -584,7 +1816,7 @@ if __name__ == "__main__":
     audio_path = args.audio_path
 
     SAMPLING_RATE = 16000
-    duration = len(load_audio(audio_path))/SAMPLING_RATE
+    duration = audio_duration(audio_path)
     print("Audio duration is: %2.2f seconds" % duration, file=logfile)
 
     size = args.model
@@ -620,29 +1852,46 @@ if __name__ == "__main__":
         tokenizer = create_tokenizer(tgt_language)
     else:
         tokenizer = None
-    online = OnlineASRProcessor(asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec))
+    if args.fallback_model is not None:
+        print(f"Loading the fallback {args.fallback_model}...",file=logfile)
+        fallback = load_fallback_asr(asr, args.fallback_model, args.backend, cache_dir=args.model_cache_dir)
+        online_asr = CascadeASR(asr, fallback, max_lag=args.fallback_lag, recover_lag=args.recover_lag)
+    else:
+        fallback = None
+        online_asr = asr
+    online = OnlineASRProcessor(online_asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),vad=args.processor_vad != "off")
 
 
-    # load the audio into the LRU cache before we start the timer
+    # map the audio file before we start the timer
     a = load_audio_chunk(audio_path,0,1)
 
     # warm up the ASR, because the very first transcribe takes much more time than the other
     asr.transcribe(a)
+    if fallback is not None:
+        fallback.transcribe(a)
+
+    if args.profile_startup:
+        import_profiler.stop()
+        for line in import_profiler.report():
+            print(line,file=logfile)
+
+    # the virtual clock skips the waiting for the audio, see VirtualClock
+    clock = VirtualClock() if args.virtual_clock else time
 
     beg = args.start_at
-    start = time.time()-beg
+    start = clock.time()-beg
 
 
     if args.offline: ## offline mode processing (for testing/debugging)
         a = load_audio(audio_path)
         online.insert_audio_chunk(a)
         try:
-            o = online.process_iter()
+            o, _ = online.process_iter()
         except AssertionError:
             print("assertion error",file=logfile)
             pass
         else:
-            output_transcript(o)
+            output_transcript(o, start)
         now = None
     elif args.comp_unaware:  # computational unaware mode 
         end = beg + min_chunk
@@ -650,7 +1899,7 @@ if __name__ == "__main__":
             a = load_audio_chunk(audio_path,beg,end)
             online.insert_audio_chunk(a)
             try:
-                o = online.process_iter()
+                o, _ = online.process_iter()
             except AssertionError:
                 print("assertion error",file=logfile)
                 pass
@@ -671,29 +1920,39 @@ if __name__ == "__main__":
         now = duration
 
     else: # online = simultaneous mode
+        if args.target_latency is not None:
+            controller = AdaptiveChunkController(args.target_latency, min_chunk, online=online if args.adaptive_trimming else None)
+            min_chunk = controller.chunk_size
+        else:
+            controller = None
         end = 0
         while True:
-            now = time.time() - start
+            now = clock.time() - start
             if now < end+min_chunk:
-                time.sleep(min_chunk+end-now)
-            end = time.time() - start
+                clock.sleep(min_chunk+end-now)
+            end = clock.time() - start
             a = load_audio_chunk(audio_path,beg,end)
             beg = end
             online.insert_audio_chunk(a)
 
+            processing_start = clock.time()
             try:
-                o = online.process_iter()
+                o, _ = online.process_iter()
             except AssertionError:
                 print("assertion error",file=logfile)
                 pass
             else:
-                output_transcript(o, start)
-            now = time.time() - start
+                output_transcript(o, now=clock.time() - start)
+            now = clock.time() - start
             print(f"## last processed {end:.2f} s, now is {now:.2f}, the latency is {now-end:.2f}",file=logfile,flush=True)
+            if controller is not None:
+                min_chunk = controller.update(clock.time() - processing_start, lag=now-end)
+            if fallback is not None:
+                online_asr.update(now-end)
 
             if end >= duration:
                 break
-        now = None
+        now = clock.time() - start
 
     o = online.finish()
     output_transcript(o, start, now=now)
@@ -7,11 +7,9 @@ import argparse
 import os
 import csv
 import json
-import torch
 import time
 import sys
 import numpy as np
-import gc
 
 from tqdm import tqdm
 from linastt.utils.monitoring import tic, toc, vram_peak, ram_peak 
@@ -49,6 +47,10 @@ def export_processing_times(args, processing_times):
             f.write(f"\t\tMin: {np.min(processing_times[i]['segment_processing_time']):.2f}\n")
             f.write(f"\t\tStd: {np.std(processing_times[i]['segment_processing_time']):.2f}\n")
             f.write(f"\t\tMedian: {np.median(processing_times[i]['segment_processing_time']):.2f}\n")
+            if 'stages' in processing_times[i]:
+                f.write(f"\t\tStages (mean / p90 / max):\n")
+                for stage, h in processing_times[i]['stages']['stages'].items():
+                    f.write(f"\t\t\t{stage}: {h['mean']:.3f} / {h['p90']:.3f} / {h['max']:.3f} ({h['count']} times)\n")
 
 def export_params(args):
     with open(os.path.join(args.output_path,"params.txt"),"w") as f:
@@ -60,15 +62,21 @@ def export_params(args):
         f.write(f"Task: {args.task}\n")  
         f.write(f"Device: {args.device}\n")
         if args.device == "cuda":
+            import torch
             f.write(f"GPU: {torch.cuda.get_device_name()}\n")
         else:
             f.write(f"CPU threads: {args.cpu_threads}\n")
+        f.write(f"Workers: {args.workers}\n")
         f.write(f"Offline: {args.offline}\n")
         f.write(f"Comp unaware: {args.comp_unaware}\n")
+        f.write(f"Virtual clock: {args.virtual_clock}\n")
 
         f.write(f"Buffer trimming: {args.buffer_trimming}\n")
         f.write(f"Buffer trimming sec: {args.buffer_trimming_sec}\n")
         f.write(f"Min chunk size: {args.min_chunk_size}\n")
+        f.write(f"Target latency: {args.target_latency}\n")
+        f.write(f"Adaptive trimming: {args.adaptive_trimming}\n")
+        f.write(f"Fallback model: {args.fallback_model} (lag {args.fallback_lag}s, recover {args.recover_lag}s)\n")
     
         f.write(f"Output path: {args.output_path}\n")
 
@@ -125,12 +133,14 @@ def process_file(audio_path, args, online, processing_times):
     if MODE=="streaming":
         confirmed_transcription = ""
 
-    duration = len(whisper_online.load_audio(audio_path))/SAMPLING_RATE
+    duration = whisper_online.audio_duration(audio_path)
     logger.info("")
     logger.info(f"Processing {audio_path} (duration is {duration:.2f}s)")
 
+    # the virtual clock skips the waiting for the audio in the simultaneous mode, see whisper_online.VirtualClock
+    clock = whisper_online.VirtualClock() if args.virtual_clock else time
     beg = args.start_at
-    start = time.time() - beg
+    start = clock.time() - beg
     os.makedirs(os.path.join(args.output_path,"transcripts"),exist_ok=True)
     
     processing_times[audio_path] = {'max_vram': -1,'segment_duration' : [], 'segment_timestamps': [], 'segment_processing_time': []}
@@ -196,17 +206,27 @@ def process_file(audio_path, args, online, processing_times):
         end = 0
         
         buffered_time = 0
-        from playsound import playsound
-        playsound(os.path.abspath(audio_path), False)
+        cascade = online.asr if isinstance(online.asr, whisper_online.CascadeASR) else None
+        if cascade is not None:
+            cascade.reset()
+        if args.target_latency is not None:
+            online.buffer_trimming_sec = args.buffer_trimming_sec  # the previous file could adapt it
+            controller = whisper_online.AdaptiveChunkController(args.target_latency, min_chunk, online=online if args.adaptive_trimming else None)
+            min_chunk = controller.chunk_size
+        else:
+            controller = None
+        if not args.virtual_clock:
+            from playsound import playsound
+            playsound(os.path.abspath(audio_path), False)
         if MODE=="benchmark":
             pbar = tqdm(total=round(duration,3))
         while True:
-            now = time.time() - start
+            now = clock.time() - start
             if now < end+min_chunk:
-                time.sleep(min_chunk+end-now)
-            end = time.time() - start
+                clock.sleep(min_chunk+end-now)
+            end = clock.time() - start
             logger.debug(f"Processing {beg:.2f} to {end:.2f}")
-            start_time = time.time()
+            start_time = clock.time()
             a = whisper_online.load_audio_chunk(audio_path, beg, end)
             
             online.insert_audio_chunk(a)
@@ -214,7 +234,7 @@ def process_file(audio_path, args, online, processing_times):
             processing_times[audio_path]['segment_timestamps'].append((online.buffer_time_offset,online.buffer_time_offset+len(online.audio_buffer)/online.SAMPLING_RATE))
             try:
                 committed, buffer = online.process_iter()
-                end_time = time.time()
+                end_time = clock.time()
             except AssertionError:
                 logger.info("assertion error")
                 pass
@@ -229,7 +249,7 @@ def process_file(audio_path, args, online, processing_times):
                         output_timed(buffer, out_time=end_time-start)
                 buffered_time = end_time-start
                 transcripts.append(committed)
-            now = time.time() - start
+            now = clock.time() - start
             processing_times[audio_path]['segment_processing_time'].append(end_time-start_time)
             if committed[0] is not None:
                 processing_times[audio_path]['segment_latency'].append(now - committed[1])
@@ -238,6 +258,10 @@ def process_file(audio_path, args, online, processing_times):
                 processing_times[audio_path]['segment_start_buffer_latency'].append(now - buffer[0])
                 processing_times[audio_path]['segment_buffer_latency'].append(now - buffer[1])
             logger.debug(f"The latency is {now-end:.2f}s and output is '{committed[2]}'")
+            if controller is not None:
+                min_chunk = controller.update(clock.time()-start_time, lag=now-end)
+            if cascade is not None:
+                cascade.update(now-end)
             if MODE=="benchmark":
                 pbar.n = min(round(end,3), pbar.total)
                 pbar.refresh()
@@ -245,9 +269,13 @@ def process_file(audio_path, args, online, processing_times):
             if end >= duration:# or beg>=40:
                 break
             
+        if cascade is not None:
+            processing_times[audio_path]['fallback_switches'] = cascade.switches
+            processing_times[audio_path]['fallback_iterations'] = cascade.fallback_iterations
         now = None
 
     if args.device == "cuda":
+        import torch
         processing_times[audio_path]['max_vram'] = vram_peak()
         try:
             logger.info(f'Number of GPUS: {os.environ["CUDA_VISIBLE_DEVICES"]}')
@@ -256,6 +284,9 @@ def process_file(audio_path, args, online, processing_times):
         logger.info(f"GPU used: {torch.cuda.get_device_name()}")
     o = online.finish()
     transcripts.append(o)
+    processing_times[audio_path]['iterations'] = online.iterations
+    processing_times[audio_path]['skipped_iterations'] = online.skipped_iters
+    processing_times[audio_path]['stages'] = online.stats.summary()
     # logging.getLogger(__name__).setLevel(level=logging.INFO)
     if MODE!="benchmark" and not args.offline and not args.comp_unaware:
         if MODE=="streaming":
@@ -265,7 +296,8 @@ def process_file(audio_path, args, online, processing_times):
     export_transcipt(transcripts, os.path.join(args.output_path,"transcripts",os.path.basename(audio_path).replace(".mp3",".txt").replace(".wav",".txt").replace(".flac",".txt")))
     return processing_times
 
-def init_args():
+def init_args(argv=None):
+    """argv: the command line arguments, sys.argv[1:] if None"""
     parser = argparse.ArgumentParser()
     parser.add_argument('audio_path', type=str, help="Filename (or folder) of 16kHz mono channel wav, on which live streaming is simulated.")
     # parser.add_argument('--folder', action="store_true", help="If set, audio_path is a folder with wav files, not a single file.")
@@ -273,15 +305,22 @@ def init_args():
     parser.add_argument('--start_at', type=float, default=0.0, help='Start processing audio at this time.')
     parser.add_argument('--offline', action="store_true", default=False, help='Offline mode.')
     parser.add_argument('--comp_unaware', action="store_true", default=False, help='Computationally unaware simulation.')
+    parser.add_argument('--virtual_clock', action="store_true", default=False, help='Simultaneous mode with a virtual clock: the processing time passes, the waiting for the audio is skipped (and the audio is not played). The latencies are as in the real-time simulation, but it runs as fast as the processing.')
     parser.add_argument('--device', type=str, default="cuda", choices=["cuda", "cpu"],help='Device used.')
     parser.add_argument('--compute_type', type=str, default="int8", choices=["int8", "float16", "float32", "int8_float16"], help='Computation type (int8, float16...).')
     parser.add_argument('--output_path', type=str, default="./", help='Output folder of the script.')
     parser.add_argument('--method', type=str, default="greedy", choices=["beam-search", "greedy"],help='Greedy or beam search decoding.')
     parser.add_argument('--verbose', default=1, help='Verbose mode (2=DEBUG, 1=INFO, 0=ERROR).')
-    parser.add_argument('--cpu_threads', default=4, help='When running on CPU, number of threads to use.')
+    parser.add_argument('--cpu_threads', default=None, help='When running on CPU, number of threads to use (per worker). Default: 4, or the CPU cores divided by --workers.')
+    parser.add_argument('--workers', type=int, default=1, help='Process the files by this many worker processes, each with its own model. The results are merged into one result.json.')
     parser.add_argument('--previous_text', action="store_true", default=False, help='Condition on previous text (default False).')
+    parser.add_argument('--iteration_log', type=str, default=None, help='Write the per-stage timings of every iteration into this file, one JSON object per line.')
+    parser.add_argument('--record', type=str, default=None, help='Record the results of all the ASR calls into this file, for --replay.')
+    parser.add_argument('--replay', type=str, default=None, help='Do not load any model, replay the ASR results recorded by --record. The audio and the options must be the same as when recording, use --comp_unaware and --device cpu.')
+    parser.add_argument('--replay_delay', type=str, default="0", help='Simulated duration of a replayed ASR call in seconds, or "recorded" for the duration measured when recording.')
+    parser.add_argument('--replay_strict', action="store_true", default=False, help='Fail on an ASR call that is not in the recording, instead of returning no words.')
     parser.add_argument('--subfolders', action="store_true", default=False, help='Search for audios in subfolders (default False).')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.verbose==2:
         logging.getLogger(__name__).setLevel(level=logging.DEBUG)
         # logging.getLogger('numba').setLevel(logging.WARNING)
@@ -296,24 +335,38 @@ def init_args():
     if args.offline and args.comp_unaware:
         logger.error("No or one option from --offline and --comp_unaware are available, not both. Exiting.")
         sys.exit(1)
+    if args.cpu_threads is None:
+        args.cpu_threads = 4 if args.workers <= 1 else max(1, (os.cpu_count() or 1) // args.workers)
+    if args.record is not None and args.replay is not None:
+        logger.error("No or one option from --record and --replay are available, not both. Exiting.")
+        sys.exit(1)
+    if args.fallback_model is not None and (args.record is not None or args.replay is not None):
+        logger.error("--fallback-model can't be recorded or replayed. Exiting.")
+        sys.exit(1)
+    if args.processor_vad is None:
+        # the replay needs no torch, and the recording must be made with the same option to be replayed
+        args.processor_vad = "off" if args.record is not None or args.replay is not None else "on"
     return args
 
-def init_processor(args):
+def init_processor(args, handles=None):
+    """handles: if a list, the handles acquired from whisper_online.models are appended to it, for releasing them"""
     size = args.model
     language = args.lan
 
     t = time.time()
     logger.info(f"Loading Whisper {size} model for {language}...")
     model_kwargs = {'device': args.device, 'cpu_threads': int(args.cpu_threads), 'compute_type': args.compute_type}
-    if args.backend == "faster-whisper":
-        asr_cls = whisper_online.FasterWhisperASR
+    if args.replay is not None:
+        # no model, the results of the recorded transcribe calls
+        delay = args.replay_delay if args.replay_delay == "recorded" else float(args.replay_delay)
+        asr = whisper_online.ReplayASR(args.replay, delay=delay, strict=args.replay_strict)
     else:
-        asr_cls = whisper_online.WhisperTimestampedASR
-        if args.backend == "whisper_timestamped-transformers":
-            model_kwargs['backend'] = "transformers"
-        else:
-            model_kwargs['backend'] = "openai-whisper"
-    asr = asr_cls(modelsize=size, lan=language, model_kwargs=model_kwargs)
+        # loaded once per process, see whisper_online.ModelRegistry
+        asr = whisper_online.models.asr(args.backend, modelsize=size, lan=language, cache_dir=args.model_cache_dir, model_dir=args.model_dir, model_kwargs=model_kwargs)
+        if handles is not None:
+            handles.append(asr)
+        if args.record is not None:
+            asr = whisper_online.ReplayASR(args.record, asr=asr)
 
     if args.method != "greedy":
         asr.transcribe_kargs['beam_size'] = 5
@@ -333,12 +386,22 @@ def init_processor(args):
     if args.vad:
         logger.info(f"setting VAD filter {args.vad}")
         asr.use_vad(args.vad if args.vad!=True else None)
+
+    if args.fallback_model is not None:
+        # the files that fall behind the real time switch to it, see whisper_online.CascadeASR
+        logger.info(f"Loading the fallback {args.fallback_model}")
+        fallback = whisper_online.load_fallback_asr(asr, args.fallback_model, args.backend, cache_dir=args.model_cache_dir, model_kwargs=model_kwargs)
+        if handles is not None and args.fallback_model != "greedy":  # "greedy" is a copy of asr, not from the registry
+            handles.append(fallback)
+        asr = whisper_online.CascadeASR(asr, fallback, max_lag=args.fallback_lag, recover_lag=args.recover_lag)
     
     if args.buffer_trimming == "sentence":
-        tokenizer = whisper_online.create_tokenizer(tgt_language)
+        tokenizer = whisper_online.models.tokenizer(tgt_language)
+        if handles is not None:
+            handles.append(tokenizer)
     else:
         tokenizer = None
-    online_processor = whisper_online.OnlineASRProcessor(asr,tokenizer,logfile=logger,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec))
+    online_processor = whisper_online.OnlineASRProcessor(asr,tokenizer,logfile=logger,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),vad=args.processor_vad != "off")
     return online_processor
 
 def get_file_list(args):
@@ -361,27 +424,100 @@ def get_file_list(args):
         audios_path = [args.audio_path]
     return audios_path
 
-if __name__ == "__main__":
+class IterationLog:
+    """writes the per-stage timings of every iteration into a file, one JSON object per line, with the processed file"""
 
-    args = init_args()
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.audio_path = None
 
-    audios_path = get_file_list(args)
+    def __call__(self, stats):
+        self.file.write(json.dumps(dict(stats.as_dict(), file=self.audio_path)) + "\n")
+
+    def close(self):
+        self.file.close()
+
+def warm_up(online_processor, audio_path):
+    # map the audio file before we start the timer
+    a = whisper_online.load_audio_chunk(audio_path,0,1)
+
+    # warm up the ASR, because the very first transcribe takes much more time than the other
+    online_processor.asr.transcribe(a)
+    if isinstance(online_processor.asr, whisper_online.CascadeASR):
+        online_processor.asr.fallback.transcribe(a)
+
+def process_files(audios_path, args, online_processor, iteration_log=None):
+    """Warms up the ASR and processes the files one by one with the same processor. Returns processing_times."""
+    warm_up(online_processor, audios_path[0])
 
     processing_times = {}
     for audio_path in tqdm(audios_path, total=len(audios_path)):
-        online_processor = init_processor(args)
-        # load the audio into the LRU cache before we start the timer
-        a = whisper_online.load_audio_chunk(audios_path[0],0,1)
-
-        # warm up the ASR, because the very first transcribe takes much more time than the other
-        online_processor.asr.transcribe(a)
+        online_processor.init()
+        if iteration_log is not None:
+            iteration_log.audio_path = audio_path
         processing_times = process_file(audio_path, args, online_processor, processing_times)
-        online_processor = None
-        gc.collect()
-                
-    export_processing_times(args, processing_times)
-    export_params(args)
+    return processing_times
+
+# the state of a worker process of --workers, set by _init_worker
+_worker = {}
+
+def _init_worker(args, worker_ids, warmup_path):
+    worker_id = worker_ids.get()
+    online_processor = init_processor(args)
+    iteration_log = None
+    if args.iteration_log is not None:
+        iteration_log = IterationLog(f"{args.iteration_log}.{worker_id}")
+        online_processor.add_iteration_hook(iteration_log)
+    warm_up(online_processor, warmup_path)
+    _worker.update(args=args, online_processor=online_processor, iteration_log=iteration_log)
+
+def _process_file_in_worker(audio_path):
+    online_processor = _worker['online_processor']
+    online_processor.init()
+    iteration_log = _worker['iteration_log']
+    if iteration_log is not None:
+        iteration_log.audio_path = audio_path
+    processing_times = process_file(audio_path, _worker['args'], online_processor, {})
+    if iteration_log is not None:
+        iteration_log.file.flush()  # the pool doesn't close it
+    return processing_times
 
+def process_files_in_workers(audios_path, args):
+    """Processes the files by args.workers processes, each of them loads the model once and gets args.cpu_threads
+    threads. The files are assigned to the workers as they become free. Returns the merged processing_times, in the
+    order of audios_path."""
+    import multiprocessing
+    # a new interpreter for every worker, CUDA can't be used in a forked process
+    context = multiprocessing.get_context("spawn")
+    worker_ids = context.Manager().Queue()
+    for i in range(args.workers):
+        worker_ids.put(i)
+    results = {}
+    with context.Pool(args.workers, initializer=_init_worker, initargs=(args, worker_ids, audios_path[0])) as pool:
+        for times in tqdm(pool.imap_unordered(_process_file_in_worker, audios_path), total=len(audios_path)):
+            results.update(times)
+    return {audio_path: results[audio_path] for audio_path in audios_path if audio_path in results}
 
+if __name__ == "__main__":
 
+    args = init_args()
 
+    audios_path = get_file_list(args)
+
+    if args.workers > 1:
+        logger.info(f"Processing by {args.workers} workers with {args.cpu_threads} CPU threads each")
+        processing_times = process_files_in_workers(audios_path, args)
+    else:
+        # the model and the processor are created once and reused for all the files
+        online_processor = init_processor(args)
+        iteration_log = None
+        if args.iteration_log is not None:
+            iteration_log = IterationLog(args.iteration_log)
+            online_processor.add_iteration_hook(iteration_log)
+
+        processing_times = process_files(audios_path, args, online_processor, iteration_log)
+
+        if iteration_log is not None:
+            iteration_log.close()
+    export_processing_times(args, processing_times)
+    export_params(args)
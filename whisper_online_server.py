@@ -1,7 +1,18 @@
 #!/usr/bin/env python3
-from whisper_online import *
+import time
+started = time.time()  # for the startup time report
 
 import sys
+if "--profile-startup" in sys.argv:
+    # before any other import, the option is parsed later
+    from startup_profile import ImportProfiler
+    import_profiler = ImportProfiler()
+    import_profiler.start()
+else:
+    import_profiler = None
+
+from whisper_online import *
+
 import argparse
 import os
 parser = argparse.ArgumentParser()
@@ -9,6 +20,15 @@ parser = argparse.ArgumentParser()
 # server options
 parser.add_argument("--host", type=str, default='localhost')
 parser.add_argument("--port", type=int, default=43007)
+parser.add_argument("--max-sessions", type=int, default=4, help="Maximum number of concurrent client connections. The connections above this limit are closed right after they are accepted.")
+parser.add_argument("--decode-threads", type=int, default=1, help="Number of threads that run process_iter of the sessions. All the sessions share one model, so more than 1 is useful only for the backends that can run concurrent inference (faster-whisper).")
+parser.add_argument("--batch-window", type=float, default=0, help="If positive, the transcribe calls of the sessions that arrive within this many seconds are collected and passed to the backend as one batch. It implies one decode thread per session.")
+parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum number of buffers in one batch, see --batch-window.")
+parser.add_argument("--websocket-port", type=int, default=None, help="Also accept WebSocket clients on this port: binary messages of s16le audio and JSON control messages in, JSON results out. It requires the websockets package.")
+parser.add_argument("--metrics-port", type=int, default=None, help="Serve the metrics of the server and its sessions in the Prometheus text format on http://HOST:METRICS_PORT/metrics.")
+parser.add_argument("--profile-startup", action="store_true", default=False, help="Log the import time of the modules that were imported until the server is ready, and the peak memory.")
+parser.add_argument("--model-idle-timeout", type=float, default=None, help="Unload the models and sentence segmenters that no session used for this many seconds, e.g. the segmenters of the languages of the WebSocket sessions. They are checked periodically. By default, they stay loaded.")
+parser.add_argument("--no-warmup", action="store_true", default=False, help="Don't warm up the model before accepting the connections. The first client then waits for the slow first transcribe calls.")
 
 
 # options from whisper_online
@@ -16,7 +36,7 @@ add_shared_args(parser)
 args = parser.parse_args()
 
 
-# setting whisper object by args 
+# setting whisper object by args
 
 SAMPLING_RATE = 16000
 
@@ -26,16 +46,10 @@ language = args.lan
 t = time.time()
 print(f"Loading Whisper {size} model for {language}...",file=sys.stderr,end=" ",flush=True)
 
-if args.backend == "faster-whisper":
-    from faster_whisper import WhisperModel
-    asr_cls = FasterWhisperASR
-else:
-    import whisper
-    import whisper_timestamped
-#    from whisper_timestamped_model import WhisperTimestampedASR
-    asr_cls = WhisperTimestampedASR
+models.idle_timeout = args.model_idle_timeout
 
-asr = asr_cls(modelsize=size, lan=language, cache_dir=args.model_cache_dir, model_dir=args.model_dir)
+# one model for all the sessions, each session has its own OnlineASRProcessor
+asr = models.asr(args.backend, modelsize=size, lan=language, cache_dir=args.model_cache_dir, model_dir=args.model_dir)
 
 if args.task == "translate":
     asr.set_translate_task()
@@ -44,6 +58,7 @@ else:
     tgt_language = language
 
 e = time.time()
+model_load_time = e-t
 print(f"done. It took {round(e-t,2)} seconds.",file=sys.stderr)
 
 if args.vad:
@@ -54,23 +69,67 @@ if args.vad:
 min_chunk = args.min_chunk_size
 
 if args.buffer_trimming == "sentence":
-    tokenizer = create_tokenizer(tgt_language)
+    tokenizer = models.tokenizer(tgt_language)
 else:
     tokenizer = None
-online = OnlineASRProcessor(asr,tokenizer,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec))
-
-
 
-demo_audio_path = "cs-maji-2.16k.wav"
-if os.path.exists(demo_audio_path):
-    # load the audio into the LRU cache before we start the timer
-    a = load_audio_chunk(demo_audio_path,0,1)
+if args.fallback_model is not None:
+    # the sessions that fall behind switch to it, see CascadeASR
+    print(f"Loading the fallback {args.fallback_model}...",file=sys.stderr,end=" ",flush=True)
+    fallback = load_fallback_asr(asr, args.fallback_model, args.backend, cache_dir=args.model_cache_dir)
+    print("done.",file=sys.stderr)
+else:
+    fallback = None
 
-    # TODO: it should be tested whether it's meaningful
-    # warm up the ASR, because the very first transcribe takes much more time than the other
-    asr.transcribe(a)
+if args.batch_window > 0:
+    # the sessions call transcribe concurrently and the scheduler batches these calls
+    session_asr = BatchingASR(asr, max_batch_size=args.max_batch_size, batch_window=args.batch_window)
+    session_fallback = None if fallback is None else BatchingASR(fallback, max_batch_size=args.max_batch_size, batch_window=args.batch_window)
+    args.decode_threads = max(args.decode_threads, args.max_sessions)
 else:
+    session_asr = asr
+    session_fallback = fallback
+
+def language_handle(model, lan, task):
+    '''a handle of the shared model for another language or task'''
+    handle = model.for_language(lan)
+    handle.transcribe_kargs.pop("task", None)
+    if task == "translate":
+        handle.set_translate_task()
+    return handle
+
+def new_online_processor(lan=None, task=None):
+    '''the processor of a new session. The WebSocket clients can choose their own language and task'''
+    lan = lan or language
+    task = task or args.task
+    if lan == language and task == args.task:
+        handle, fallback_handle, session_tokenizer = session_asr, session_fallback, tokenizer
+    else:
+        # the handles are not batched, a batch is transcribed in one language and task
+        handle = language_handle(asr, lan, task)
+        fallback_handle = None if fallback is None else language_handle(fallback, lan, task)
+        session_tokenizer = None
+        if args.buffer_trimming == "sentence":
+            session_tokenizer = models.tokenizer("en" if task == "translate" else lan)
+    if fallback_handle is not None:
+        # the models are shared, the degradation state is of the session
+        handle = CascadeASR(handle, fallback_handle, max_lag=args.fallback_lag, recover_lag=args.recover_lag)
+    return OnlineASRProcessor(handle,session_tokenizer,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),vad=args.processor_vad != "off")
+
+
+
+if args.no_warmup:
     print("Whisper is not warmed up",file=sys.stderr)
+    warmup_time = 0
+else:
+    # the first transcribe calls take much more time than the others, the first client would wait for them
+    buffer_sec = args.buffer_trimming_sec if args.buffer_trimming == "segment" else 30
+    print(f"Warming up with {min_chunk} to {buffer_sec} seconds of generated audio...",file=sys.stderr,end=" ",flush=True)
+    warmup_time = warm_up(new_online_processor, min_chunk, buffer_sec)
+    if fallback is not None:
+        # a switch must not wait for the first slow calls of the fallback
+        warmup_time += warm_up(lambda: OnlineASRProcessor(fallback,tokenizer,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),vad=args.processor_vad != "off"), min_chunk, buffer_sec)
+    print(f"done. It took {round(warmup_time,2)} seconds.",file=sys.stderr)
 
 
 
@@ -78,68 +137,154 @@ else:
 ######### Server objects
 
 import line_packet
-import socket
+from metrics import ServerMetrics, MetricsHTTPServer
+import asyncio
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 
 
 class Connection:
-    '''it wraps conn object'''
+    '''it wraps the asyncio stream pair of one client.
+    The client selects the framed format of line_packet by the handshake at the start of the stream, otherwise the
+    lines are sent as the legacy padded packets.'''
     PACKET_SIZE = 65536
+    SUPPORTED_FLAGS = line_packet.FLAG_INTERIM  # of the handshake, see line_packet
 
-    def __init__(self, conn):
-        self.conn = conn
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
         self.last_line = ""
-
-        self.conn.setblocking(True)
-
-    def send(self, line):
+        self.negotiated = False
+        self.framed = False
+        self.flags = 0  # the handshake flags accepted from the client
+
+    async def negotiate(self):
+        '''reads the first bytes of the stream. If they are the handshake, the server answers it and switches to
+        the framed format. Returns the audio bytes that were read after the handshake, or the bytes if there was none.'''
+        self.negotiated = True
+        data = await self.reader.read(self.PACKET_SIZE)
+        magic = line_packet.HANDSHAKE_MAGIC
+        if len(data) < line_packet.HANDSHAKE_SIZE and magic.startswith(data[:len(magic)]):
+            # a short read of the beginning of a handshake
+            try:
+                data += await self.reader.readexactly(line_packet.HANDSHAKE_SIZE - len(data))
+            except asyncio.IncompleteReadError as e:
+                return data + e.partial
+        handshake = line_packet.parse_handshake(data)
+        if handshake is None:
+            return data
+        version, flags = handshake
+        if version != line_packet.FRAMED_VERSION:
+            raise ConnectionError(f"unsupported protocol version {version}")
+        self.framed = True
+        self.flags = flags & self.SUPPORTED_FLAGS
+        self.writer.write(line_packet.encode_handshake(self.flags))
+        logging.debug(f"framed protocol, flags {self.flags}")
+        return data[line_packet.HANDSHAKE_SIZE:]
+
+    @property
+    def interim(self):
+        '''the client wants the typed committed and interim messages'''
+        return self.framed and bool(self.flags & line_packet.FLAG_INTERIM)
+
+    async def send(self, line):
         '''it doesn't send the same line twice, because it was problematic in online-text-flow-events'''
         if line == self.last_line:
             return
-        line_packet.send_one_line(self.conn, line)
+        await self.send_lines([line])
         self.last_line = line
 
-    def receive_lines(self):
-        in_line = line_packet.receive_lines(self.conn)
-        return in_line
-
-    def non_blocking_receive_audio(self):
-        r = self.conn.recv(self.PACKET_SIZE)
+    async def send_lines(self, lines):
+        '''sends the lines by one write and one drain'''
+        if self.framed:
+            self.writer.write(line_packet.encode_frames(lines))
+        else:
+            self.writer.writelines(p for line in lines for p in line_packet.encode_one_line(line))
+        await self.writer.drain()
+
+    async def non_blocking_receive_audio(self):
+        if not self.negotiated:
+            r = await self.negotiate()
+            if r or self.reader.at_eof():
+                return r
+        r = await self.reader.read(self.PACKET_SIZE)
         return r
 
-
-import io
-import soundfile
-
-# wraps socket and ASR object, and serves one client connection. 
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, BrokenPipeError):
+            pass
+
+
+class PCM16Decoder:
+    '''decodes the headerless s16le audio of the client into float32 samples, the same as librosa.load of a RAW PCM_16 soundfile.
+    The samples are written into a preallocated array, an odd trailing byte of a packet is kept for the next one.'''
+
+    def __init__(self, capacity):
+        self.samples = np.empty(max(int(capacity), 1), dtype=np.float32)
+        self.n = 0
+        self.carry = b""
+
+    def __len__(self):
+        return self.n
+
+    def add(self, raw_bytes):
+        if self.carry:
+            raw_bytes = self.carry + raw_bytes
+        k = len(raw_bytes) // 2
+        self.carry = raw_bytes[2*k:]
+        if self.n + k > len(self.samples):
+            samples = np.empty(max(2*len(self.samples), self.n + k), dtype=np.float32)
+            samples[:self.n] = self.samples[:self.n]
+            self.samples = samples
+        np.multiply(np.frombuffer(raw_bytes, dtype="<i2", count=k), 1/32768, out=self.samples[self.n:self.n+k], casting="unsafe")
+        self.n += k
+
+    def take(self):
+        '''returns the decoded samples and starts a new chunk. The returned array is valid until the next add.'''
+        out = self.samples[:self.n]
+        self.n = 0
+        return out
+
+
+# wraps the connection and the session's own OnlineASRProcessor, and serves one client connection.
 # next client should be served by a new instance of this object
 class ServerProcessor:
 
-    def __init__(self, c, online_asr_proc, min_chunk):
+    def __init__(self, c, online_asr_proc, min_chunk, executor, metrics, controller=None):
         self.connection = c
         self.online_asr_proc = online_asr_proc
-        self.min_chunk = min_chunk
+        self.min_chunk = min_chunk if controller is None else controller.chunk_size
+        self.executor = executor
+        self.metrics = metrics
+        self.controller = controller  # AdaptiveChunkController or None for the fixed min_chunk
 
+        self.audio_started = None  # the wall-clock time of the beginning of the audio, for the lag
+        self.cascade = online_asr_proc.asr if isinstance(online_asr_proc.asr, CascadeASR) else None
         self.last_end = None
+        self.last_interim = "I"  # nothing to replace at the start
+        self.committed_words = 0
+        self.pcm = PCM16Decoder(min_chunk*SAMPLING_RATE + Connection.PACKET_SIZE)
 
-    def receive_audio_chunk(self):
+    async def receive_audio_chunk(self):
         # receive all audio that is available by this time
         # blocks operation if less than self.min_chunk seconds is available
         # unblocks if connection is closed or a chunk is available
-        out = []
-        while sum(len(x) for x in out) < self.min_chunk*SAMPLING_RATE:
-            raw_bytes = self.connection.non_blocking_receive_audio()
-            print(raw_bytes[:10])
-            print(len(raw_bytes))
+        while len(self.pcm) < self.min_chunk*SAMPLING_RATE:
+            raw_bytes = await self.connection.non_blocking_receive_audio()
             if not raw_bytes:
                 break
-            sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1,endian="LITTLE",samplerate=SAMPLING_RATE, subtype="PCM_16",format="RAW")
-            audio, _ = librosa.load(sf,sr=SAMPLING_RATE)
-            out.append(audio)
-        if not out:
+            self.metrics.add_packet(raw_bytes)
+            self.pcm.add(raw_bytes)
+        if len(self.pcm) == 0:
             return None
-        return np.concatenate(out)
+        # insert_audio_chunk copies it into the processor's buffer before the next receive
+        return self.pcm.take()
 
     def format_output_transcript(self,o):
         # output format in stdout is like:
@@ -165,31 +310,311 @@ class ServerProcessor:
             print(o,file=sys.stderr,flush=True)
             return None
 
-    def send_result(self, o):
+    def format_interim(self, incomplete):
+        # "I beg end text" is the unconfirmed tail of the buffer, it replaces the previous interim message.
+        # A bare "I" clears it.
+        if incomplete[0] is None:
+            return "I"
+        beg, end = incomplete[0]*1000, incomplete[1]*1000
+        if self.last_end is not None:
+            beg = max(beg, self.last_end)
+        return "I %1.0f %1.0f %s" % (beg,end,incomplete[2])
+
+    async def send_result(self, o, incomplete=None):
         msg = self.format_output_transcript(o)
+        if not self.connection.interim:
+            if msg is not None:
+                await self.connection.send(msg)
+            return
+        # at most one committed and one interim message per iteration, sent together
+        lines = []
         if msg is not None:
-            self.connection.send(msg)
-
-    def process(self):
+            lines.append("C " + msg)
+        interim = self.format_interim(incomplete)
+        if interim != self.last_interim:
+            lines.append(interim)
+            self.last_interim = interim
+        if lines:
+            await self.connection.send_lines(lines)
+
+    async def process(self):
         # handle one client connection
+        loop = asyncio.get_running_loop()
         self.online_asr_proc.init()
         while True:
-            a = self.receive_audio_chunk()
+            a = await self.receive_audio_chunk()
             if a is None:
-                print("break here",file=sys.stderr)
+                logging.debug(f"session {self.metrics.session_id}: end of audio")
                 break
             self.online_asr_proc.insert_audio_chunk(a)
-            o = online.process_iter()
+            beg = time.time()
+            if self.audio_started is None:
+                self.audio_started = beg - len(a)/SAMPLING_RATE
+            # the model call blocks, it runs outside of the event loop so that the other sessions keep receiving
+            o, _ = await loop.run_in_executor(self.executor, self.online_asr_proc.process_iter)
+            # the whole unconfirmed tail, process_iter returns only the words that were added to it now
+            incomplete = self.online_asr_proc.to_flush(self.online_asr_proc.transcript_buffer.complete())
+            committed_words = self.online_asr_proc.commited.count
+            self.metrics.add_iteration(len(a)/SAMPLING_RATE, time.time()-beg, committed_words-self.committed_words, o[1],
+                                       buffer_seconds=len(self.online_asr_proc.audio_buffer)/SAMPLING_RATE)
+            self.committed_words = committed_words
+            self.metrics.skipped_iterations = self.online_asr_proc.skipped_iters
+            # how far the end of the processed audio is behind the real time of a real-time client
+            lag = time.time() - self.audio_started - self.metrics.audio_seconds
+            if self.controller is not None:
+                self.min_chunk = self.controller.update(time.time()-beg, lag=lag)
+            self.metrics.min_chunk_size = self.min_chunk
+            if self.cascade is not None:
+                if self.cascade.update(lag):
+                    self.metrics.add_switch(self.cascade.degraded)
             try:
-                self.send_result(o)
-            except BrokenPipeError:
-                print("broken pipe -- connection closed?",file=sys.stderr)
+                await self.send_result(o, incomplete)
+            except (BrokenPipeError, ConnectionError):
+                logging.info(f"session {self.metrics.session_id}: broken pipe -- connection closed?")
                 break
 
 #        o = online.finish()  # this should be working
 #        self.send_result(o)
 
 
+class ControlMessageError(ValueError):
+    '''an invalid control message of a WebSocket client'''
+
+
+class WebSocketConnection:
+    '''it wraps one WebSocket client with the interface of Connection. The binary messages are s16le audio, the text
+    messages are JSON control messages. The first one may configure the session:
+        {"language": "de", "task": "transcribe", "min_chunk_size": 1.0, "interim": true}
+    and {"eos": true} ends the audio, the rest of the transcript is then sent and the server closes the connection.'''
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.eos = False
+        self.interim = False
+        self.processor = None  # the WebSocketProcessor, it takes min_chunk_size from the later control messages
+
+    async def receive_config(self):
+        '''returns the configuration of the session and the audio of the first message, if it wasn't a control message'''
+        message = await self._recv()
+        if not isinstance(message, str):
+            return {}, message or b""
+        config = self._parse(message)
+        if "language" in config and not isinstance(config["language"], str):
+            raise ControlMessageError("language must be a string")
+        if config.get("task", "transcribe") not in ("transcribe", "translate"):
+            raise ControlMessageError("task must be transcribe or translate")
+        self._control(config)
+        return config, b""
+
+    async def non_blocking_receive_audio(self):
+        while not self.eos:
+            message = await self._recv()
+            if message is None:
+                return b""
+            if not isinstance(message, str):
+                if message:
+                    return message
+                continue
+            config = self._parse(message)
+            if "language" in config or "task" in config:
+                raise ControlMessageError("language and task can be set only by the first message")
+            self._control(config)
+        return b""
+
+    def _parse(self, message):
+        try:
+            config = json.loads(message)
+        except ValueError:
+            raise ControlMessageError("control messages must be JSON")
+        if not isinstance(config, dict):
+            raise ControlMessageError("control messages must be JSON objects")
+        return config
+
+    def _control(self, config):
+        if "min_chunk_size" in config:
+            min_chunk = config["min_chunk_size"]
+            if isinstance(min_chunk, bool) or not isinstance(min_chunk, (int, float)) or not 0 < min_chunk <= 30:
+                raise ControlMessageError("min_chunk_size must be a number of seconds between 0 and 30")
+            if self.processor is not None:
+                # the chunk size of the client replaces the adaptive one
+                self.processor.min_chunk = min_chunk
+                self.processor.controller = None
+        if "interim" in config:
+            self.interim = bool(config["interim"])
+        if config.get("eos"):
+            self.eos = True
+
+    async def _recv(self):
+        import websockets
+        try:
+            return await self.websocket.recv()
+        except websockets.exceptions.ConnectionClosed:
+            return None
+
+    async def send_json(self, message):
+        import websockets
+        try:
+            await self.websocket.send(json.dumps(message, ensure_ascii=False))
+        except websockets.exceptions.ConnectionClosed as e:
+            raise ConnectionError(str(e))
+
+    async def close(self, code=1000, reason=""):
+        await self.websocket.close(code=code, reason=reason)
+
+
+class WebSocketProcessor(ServerProcessor):
+    '''serves one WebSocket client, the results are JSON messages with the timestamps in seconds:
+        {"type": "committed", "start": 0.0, "end": 1.72, "text": "Takhle to je"}
+        {"type": "interim", "start": 1.72, "end": 2.3, "text": "a tady"}
+    The interim messages are sent only if the client asked for them, {"type": "interim", "start": null, ...} clears
+    the previous one. {"type": "eos"} is the last message after {"eos": true} of the client.'''
+
+    def __init__(self, c, online_asr_proc, min_chunk, executor, metrics, controller=None, audio=b""):
+        super().__init__(c, online_asr_proc, min_chunk, executor, metrics, controller=controller)
+        c.processor = self
+        self.last_interim = None
+        if audio:
+            self.metrics.add_packet(audio)
+            self.pcm.add(audio)
+
+    async def send_result(self, o, incomplete=None):
+        messages = []
+        if o[0] is not None:
+            beg, end = o[0]*1000, o[1]*1000
+            if self.last_end is not None:
+                beg = max(beg, self.last_end)
+            self.last_end = end
+            messages.append({"type": "committed", "start": round(beg/1000, 3), "end": round(end/1000, 3), "text": o[2]})
+        if self.connection.interim and incomplete is not None:
+            if incomplete[0] is None:
+                interim = (None, None, "")
+            else:
+                beg = incomplete[0]*1000
+                if self.last_end is not None:
+                    beg = max(beg, self.last_end)
+                interim = (round(beg/1000, 3), round(incomplete[1], 3), incomplete[2])
+            if interim != self.last_interim and (self.last_interim is not None or interim[0] is not None):
+                messages.append({"type": "interim", "start": interim[0], "end": interim[1], "text": interim[2]})
+            self.last_interim = interim
+        for m in messages:
+            await self.connection.send_json(m)
+
+    async def process(self):
+        await super().process()
+        if self.connection.eos:
+            # the client ended the audio and waits for the rest of the transcript
+            loop = asyncio.get_running_loop()
+            o = await loop.run_in_executor(self.executor, self.online_asr_proc.finish)
+            await self.send_result(o, (None, None, ""))
+            await self.connection.send_json({"type": "eos"})
+
+
+class Server:
+    '''accepts the client connections, each of them is served concurrently by its own ServerProcessor'''
+
+    def __init__(self, new_online_processor, min_chunk, max_sessions, decode_threads=1, target_latency=None, adaptive_trimming=False):
+        self.new_online_processor = new_online_processor
+        self.min_chunk = min_chunk
+        self.max_sessions = max_sessions
+        self.target_latency = target_latency
+        self.adaptive_trimming = adaptive_trimming
+        self.executor = ThreadPoolExecutor(max_workers=decode_threads, thread_name_prefix="whisper-decode")
+
+        self.metrics = ServerMetrics()
+        self.sessions = self.metrics.sessions  # session id -> SessionMetrics of the active sessions
+        self.session_ids = itertools.count(1)
+
+    def new_controller(self, online):
+        '''the AdaptiveChunkController of a session, or None if the chunk size is fixed'''
+        if self.target_latency is None:
+            return None
+        return AdaptiveChunkController(self.target_latency, self.min_chunk, online=online if self.adaptive_trimming else None)
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        connection = Connection(reader, writer)
+        if len(self.sessions) >= self.max_sessions:
+            logging.warning(f'Refusing client {peer}, {len(self.sessions)} sessions are active (--max-sessions {self.max_sessions})')
+            self.metrics.refused += 1
+            await connection.close()
+            return
+        metrics = self.metrics.new_session(next(self.session_ids), peer)
+        logging.info(f'Connected to client on {peer}, session {metrics.session_id}, {len(self.sessions)} active')
+        try:
+            # it can load the VAD or a tokenizer, the other sessions must not wait for it
+            online = await asyncio.get_running_loop().run_in_executor(None, self.new_online_processor)
+            proc = ServerProcessor(connection, online, self.min_chunk, self.executor, metrics, controller=self.new_controller(online))
+            await proc.process()
+        except ConnectionError as ex:
+            logging.info(f'session {metrics.session_id}: {ex}')
+        finally:
+            self.metrics.end_session(metrics)
+            await connection.close()
+            logging.info('Connection to client closed, '+metrics.summary())
+
+    async def handle_websocket(self, websocket, path=None):
+        # path is passed by the older versions of websockets
+        peer = websocket.remote_address
+        connection = WebSocketConnection(websocket)
+        if len(self.sessions) >= self.max_sessions:
+            logging.warning(f'Refusing WebSocket client {peer}, {len(self.sessions)} sessions are active (--max-sessions {self.max_sessions})')
+            self.metrics.refused += 1
+            await connection.close(1013, "too many sessions")
+            return
+        metrics = self.metrics.new_session(next(self.session_ids), peer)
+        logging.info(f'Connected to WebSocket client on {peer}, session {metrics.session_id}, {len(self.sessions)} active')
+        online = None
+        try:
+            config, audio = await connection.receive_config()
+            online = await asyncio.get_running_loop().run_in_executor(None, self.new_online_processor, config.get("language"), config.get("task"))
+            # the chunk size of the client replaces the adaptive one
+            controller = None if "min_chunk_size" in config else self.new_controller(online)
+            proc = WebSocketProcessor(connection, online, config.get("min_chunk_size", self.min_chunk), self.executor, metrics,
+                                      controller=controller, audio=audio)
+            await proc.process()
+        except ControlMessageError as ex:
+            logging.info(f'session {metrics.session_id}: invalid control message: {ex}')
+            try:
+                await connection.send_json({"type": "error", "message": str(ex)})
+            except ConnectionError:
+                pass
+        except ConnectionError as ex:
+            logging.info(f'session {metrics.session_id}: {ex}')
+        finally:
+            self.metrics.end_session(metrics)
+            if online is not None and online.tokenizer is not None and online.tokenizer is not tokenizer:
+                # the segmenter of the session's language, it can be unloaded by --model-idle-timeout
+                models.release(online.tokenizer)
+            await connection.close()
+            logging.info('Connection to WebSocket client closed, '+metrics.summary())
+
+    async def evict_idle_models(self):
+        '''unloads the models of the registry whose idle timeout passed, also when no session starts or ends'''
+        interval = max(1, min(models.idle_timeout/2, 60))
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            # it waits for the lock of the registry, which a loading thread can hold
+            await loop.run_in_executor(None, models.evict_idle)
+
+    async def serve(self, host, port, metrics_port=None, websocket_port=None):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        logging.info('Listening on'+str((host, port)))
+        if websocket_port is not None:
+            import websockets
+            self.websocket_server = await websockets.serve(self.handle_websocket, host, websocket_port, max_size=2**20)
+            logging.info(f'WebSocket on ws://{host}:{websocket_port}')
+        if metrics_port is not None:
+            self.metrics_server = await MetricsHTTPServer(self.metrics).start(host, metrics_port)
+        logging.info(f'Ready {time.time()-started:.2f}s after start (model load {model_load_time:.2f}s, warm-up {warmup_time:.2f}s)')
+        if import_profiler is not None:
+            import_profiler.stop()
+            for line in import_profiler.report():
+                logging.info(line)
+        if models.idle_timeout is not None:
+            self.eviction = asyncio.create_task(self.evict_idle_models())
+        async with server:
+            await server.serve_forever()
 
 
 # Start logging.
@@ -198,17 +623,10 @@ logging.basicConfig(level=level, format='whisper-server-%(levelname)s: %(message
 
 # server loop
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind((args.host, args.port))
-    s.listen(1)
-    logging.info('INFO: Listening on'+str((args.host, args.port)))
-    while True:
-        conn, addr = s.accept()
-        logging.info('INFO: Connected to client on {}'.format(addr))
-        connection = Connection(conn)
-        proc = ServerProcessor(connection, online, min_chunk)
-        proc.process()
-        conn.close()
-        logging.info('INFO: Connection to client closed')
-logging.info('INFO: Connection closed, terminating.')
+server = Server(new_online_processor, min_chunk, args.max_sessions, decode_threads=args.decode_threads,
+                target_latency=args.target_latency, adaptive_trimming=args.adaptive_trimming)
+try:
+    asyncio.run(server.serve(args.host, args.port, metrics_port=args.metrics_port, websocket_port=args.websocket_port))
+except KeyboardInterrupt:
+    pass
+logging.info('Connection closed, terminating.')